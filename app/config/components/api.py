@@ -0,0 +1,38 @@
+# Movies API
+
+import os
+
+# Total of the movies list: 'exact', 'estimated' by the planner statistics
+# or 'cached' exact count refreshed every MOVIES_API_COUNT_TIMEOUT seconds
+MOVIES_API_COUNT = os.environ.get('MOVIES_API_COUNT', 'exact')
+MOVIES_API_COUNT_TIMEOUT = int(os.environ.get('MOVIES_API_COUNT_TIMEOUT', 60))
+
+# Responses of the movies API are cached until the catalog changes,
+# at most MOVIES_API_CACHE_TIMEOUT seconds
+MOVIES_API_CACHE = os.environ.get('MOVIES_API_CACHE', 'True') == 'True'
+MOVIES_API_CACHE_TIMEOUT = int(os.environ.get('MOVIES_API_CACHE_TIMEOUT', 300))
+# Seconds clients and proxies may reuse a response without revalidation
+MOVIES_API_MAX_AGE = int(os.environ.get('MOVIES_API_MAX_AGE', 0))
+
+# Movies of list pages are found in the movies index of elasticsearch
+# when enabled, and read from Postgres by their ids. After a failure
+# Postgres finds them for MOVIES_API_ES_RETRY_AFTER seconds
+MOVIES_API_ELASTICSEARCH = \
+    os.environ.get('MOVIES_API_ELASTICSEARCH', 'False') == 'True'
+MOVIES_API_ES_DSN = os.environ.get('ES_DSN', 'http://127.0.0.1:9200')
+MOVIES_API_ES_INDEX = os.environ.get('MOVIES_API_ES_INDEX', 'movies')
+MOVIES_API_ES_TIMEOUT = float(os.environ.get('MOVIES_API_ES_TIMEOUT', 2))
+MOVIES_API_ES_RETRY_AFTER = int(
+    os.environ.get('MOVIES_API_ES_RETRY_AFTER', 30)
+)
+# Seconds after a catalog change Postgres finds them, until the ETL
+# has indexed the change
+MOVIES_API_ES_LAG = int(os.environ.get('MOVIES_API_ES_LAG', 60))
+
+# Connections of the asyncpg pool used by the async movies API
+MOVIES_API_DB_POOL_MIN_SIZE = int(
+    os.environ.get('MOVIES_API_DB_POOL_MIN_SIZE', 2)
+)
+MOVIES_API_DB_POOL_MAX_SIZE = int(
+    os.environ.get('MOVIES_API_DB_POOL_MAX_SIZE', 10)
+)
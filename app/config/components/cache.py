@@ -0,0 +1,12 @@
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+
+import os
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ.get('REDIS_DSN', 'redis://127.0.0.1:6379'),
+        'KEY_PREFIX': 'admin_panel',
+    }
+}
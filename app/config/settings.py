@@ -18,6 +18,8 @@ include(
     'components/validations.py',
     'components/logging.py',
     'components/celery.py',
+    'components/cache.py',
+    'components/api.py',
 )
 
 # Quick-start development settings - unsuitable for production
@@ -49,6 +51,31 @@ class Settings(BaseSettings):
 
     ES_DSN: str = 'http://127.0.0.1:9200'
 
+    ETL_STREAMING: bool = True
+    ETL_WINDOW_HOURS: int = 0
+    ETL_REINDEX_SHARDS: int = os.cpu_count() or 1
+    ETL_PIPELINE: bool = True
+    ETL_QUEUE_SIZE: int = 2
+    ETL_ENGINE: str = 'sync'
+    ETL_MAX_IN_FLIGHT: int = 4
+    ETL_FORCE_MERGE: bool = False
+    ES_BULK_THREADS: int = 4
+    ES_BULK_CHUNK_BYTES: int = 5 * 1024 * 1024
+    ES_HTTP_COMPRESS: bool = False
+    ETL_OUTBOX_BUNCH_SIZE: int = 500
+    ETL_OUTBOX_POLL_TIMEOUT: int = 30
+    ETL_SKIP_UNCHANGED: bool = True
+    ETL_PARTIAL_UPDATES: bool = True
+    ETL_APP_JOIN: bool = False
+    ETL_NAME_CACHE_SIZE: int = 0
+    ETL_DOCUMENT_TABLE: bool = False
+    ETL_LOCK_TIMEOUT: int = 300
+    ETL_METRICS_TEXTFILE: str = ''
+    ETL_NDJSON: bool = True
+    ETL_RENDERED_BULK: bool = False
+    ETL_BENCHMARK_DB_DSN: str = ''
+    ETL_BENCHMARK_NAMESPACE: str = ''
+
     class Config:
         env_file = ".env"
 
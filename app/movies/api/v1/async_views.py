@@ -0,0 +1,128 @@
+import logging
+import math
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404, HttpResponseNotAllowed, JsonResponse
+from redis.exceptions import RedisError
+
+from movies.api.v1.pagination import COUNT_CACHE_KEY
+from movies.api.v1.pool import get_pool
+from movies.api.v1.views import MoviesListApi
+
+logger = logging.getLogger(__name__)
+
+MOVIES_QUERY = '''
+    SELECT
+        fw.id, fw.title, fw.description, fw.creation_date, fw.rating,
+        fw.type, fw.certificate, fw.file_path, fw.created, fw.modified,
+        COALESCE(
+            ARRAY_AGG(DISTINCT g.name) FILTER (WHERE g.id IS NOT null),
+            '{{}}'
+        ) AS genres,
+        COALESCE(
+            ARRAY_AGG(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'actor'),
+            '{{}}'
+        ) AS actors,
+        COALESCE(
+            ARRAY_AGG(DISTINCT p.full_name)
+                FILTER (WHERE pfw.role = 'director'),
+            '{{}}'
+        ) AS directors,
+        COALESCE(
+            ARRAY_AGG(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'writer'),
+            '{{}}'
+        ) AS writers
+    FROM content.film_work fw
+    LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+    LEFT JOIN content.genre g ON g.id = gfw.genre_id
+    LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+    LEFT JOIN content.person p ON p.id = pfw.person_id
+    WHERE {condition}
+    GROUP BY fw.id
+    ORDER BY fw.id;
+'''
+PAGE_CONDITION = '''
+    fw.id IN (
+        SELECT id FROM content.film_work ORDER BY id LIMIT $1 OFFSET $2
+    )
+'''
+
+
+async def get_movies_count(connection) -> int:
+    """
+    Same totals as get_movies_count of the sync views, also the exact
+    count while the cache is unavailable.
+    """
+    if settings.MOVIES_API_COUNT == 'estimated':
+        estimate = await connection.fetchval(
+            "SELECT reltuples::bigint FROM pg_class "
+            "WHERE oid = 'content.film_work'::regclass;"
+        )
+        if estimate >= 0:
+            return estimate
+    elif settings.MOVIES_API_COUNT == 'cached':
+        try:
+            count = await cache.aget(COUNT_CACHE_KEY)
+        except RedisError as e:
+            logger.warning(f'Movies count is not cached: {e}')
+        else:
+            if count is None:
+                count = await connection.fetchval(
+                    'SELECT count(*) FROM content.film_work;'
+                )
+                try:
+                    await cache.aset(COUNT_CACHE_KEY, count,
+                                     settings.MOVIES_API_COUNT_TIMEOUT)
+                except RedisError as e:
+                    logger.warning(f'Movies count is not cached: {e}')
+            return count
+    return await connection.fetchval('SELECT count(*) FROM content.film_work;')
+
+
+async def movies_list(request):
+    """
+    Movies by numbered pages, as MoviesListApi without search.
+    The queries run on a pooled asyncpg connection, so a worker serves
+    many requests while their queries are waiting for Postgres.
+    """
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+
+    per_page = MoviesListApi.paginate_by
+    page = request.GET.get('page', 1)
+    pool = await get_pool()
+    async with pool.acquire() as connection:
+        count = await get_movies_count(connection)
+        total_pages = max(1, math.ceil(count / per_page))
+        try:
+            page = total_pages if page == 'last' else int(page)
+        except ValueError:
+            raise Http404('Invalid page')
+        if not 1 <= page <= total_pages:
+            raise Http404('Invalid page')
+        rows = await connection.fetch(
+            MOVIES_QUERY.format(condition=PAGE_CONDITION),
+            per_page, (page - 1) * per_page
+        )
+    return JsonResponse({
+        'count': count,
+        'total_pages': total_pages,
+        'prev': page - 1 if page > 1 else None,
+        'next': page + 1 if page < total_pages else None,
+        'results': [dict(row) for row in rows],
+    })
+
+
+async def movies_detail(request, pk):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+
+    pool = await get_pool()
+    async with pool.acquire() as connection:
+        row = await connection.fetchrow(
+            MOVIES_QUERY.format(condition='fw.id = $1'), pk
+        )
+    if row is None:
+        raise Http404('No movie found matching the query')
+    return JsonResponse(dict(row))
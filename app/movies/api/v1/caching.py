@@ -0,0 +1,95 @@
+import hashlib
+import logging
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from redis.exceptions import RedisError
+
+from movies.api.v1.pagination import COUNT_CACHE_KEY
+
+logger = logging.getLogger(__name__)
+
+GENERATION_KEY = 'movies:generation'
+
+
+def get_generation() -> float:
+    """
+    Time of the last catalog change.
+    It versions the cached responses and is their Last-Modified,
+    a cache without it starts a new generation.
+    """
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, time.time(), None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def bump_generation() -> None:
+    """
+    Invalidate every cached response and the cached count.
+    An unavailable cache does not fail the change, its responses expire
+    after MOVIES_API_CACHE_TIMEOUT.
+    """
+    try:
+        cache.set(GENERATION_KEY, time.time(), None)
+        cache.delete(COUNT_CACHE_KEY)
+    except RedisError as e:
+        logger.warning(f'Cached responses were not invalidated: {e}')
+
+
+class CachedResponseMixin:
+    """
+    Serve GET responses from the shared cache.
+    Responses are cached per full path within the current generation,
+    so a catalog change invalidates them all at once. Every response
+    carries ETag and Last-Modified and conditional requests are answered
+    with 304 without building the response.
+    While the cache is unavailable responses are built without it.
+    """
+    generation = None
+
+    def get(self, request, *args, **kwargs):
+        if not settings.MOVIES_API_CACHE:
+            return super().get(request, *args, **kwargs)
+
+        path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+        try:
+            self.generation = generation = get_generation()
+            key = f'movies:response:{generation!r}:{path}'
+            cached = cache.get(key)
+        except RedisError as e:
+            logger.warning(f'Responses are not cached: {e}')
+            return super().get(request, *args, **kwargs)
+
+        if cached is None:
+            response = super().get(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            cached = (
+                response.content,
+                response['Content-Type'],
+                f'"{hashlib.md5(response.content).hexdigest()}"',
+            )
+            try:
+                cache.set(key, cached, settings.MOVIES_API_CACHE_TIMEOUT)
+            except RedisError as e:
+                logger.warning(f'Response was not cached: {e}')
+
+        content, content_type, etag = cached
+        last_modified = math.ceil(generation)
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = HttpResponse(content, content_type=content_type)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, public=True,
+                            max_age=settings.MOVIES_API_MAX_AGE)
+        return response
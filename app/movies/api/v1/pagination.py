@@ -0,0 +1,142 @@
+import base64
+import binascii
+import json
+import logging
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models import Q
+from django.http import Http404
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+from redis.exceptions import RedisError
+
+from movies.models import Filmwork
+
+logger = logging.getLogger(__name__)
+
+COUNT_CACHE_KEY = 'movies:count'
+
+
+def get_movies_count(mode: Optional[str] = None) -> int:
+    """
+    Total of the movies list.
+    The aggregated list has a row per film work, so film works are counted
+    without the joins. 'estimated' reads the planner statistics and falls
+    back to the exact count when the table was never analyzed,
+    'cached' falls back to it while the cache is unavailable.
+    """
+    mode = mode or settings.MOVIES_API_COUNT
+    if mode == 'estimated':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT reltuples::bigint FROM pg_class '
+                'WHERE oid = %s::regclass;',
+                [Filmwork._meta.db_table.replace('"', '')]
+            )
+            row = cursor.fetchone()
+        if row and row[0] >= 0:
+            return row[0]
+    elif mode == 'cached':
+        try:
+            return cache.get_or_set(COUNT_CACHE_KEY, Filmwork.objects.count,
+                                    settings.MOVIES_API_COUNT_TIMEOUT)
+        except RedisError as e:
+            logger.warning(f'Movies count is not cached: {e}')
+    return Filmwork.objects.count()
+
+
+class CountedPaginator(Paginator):
+    """Paginator taking the total from get_movies_count"""
+
+    @cached_property
+    def count(self):
+        return get_movies_count()
+
+
+class KeysetPaginator:
+    """
+    Opaque cursor pagination over (ordering field, id).
+    A cursor holds the ordering, the field value and the id of the boundary
+    movie and whether the page goes before it. Every page is found with
+    an index range scan, so its cost does not depend on how deep it is.
+    """
+    ORDERINGS = ('modified', '-modified', 'title', '-title')
+
+    def __init__(self, per_page: int, ordering: str = 'modified'):
+        if ordering not in self.ORDERINGS:
+            raise Http404(f'Invalid ordering "{ordering}"')
+        self.per_page = per_page
+        self.ordering = ordering
+        self.field = ordering.lstrip('-')
+        self.descending = ordering.startswith('-')
+
+    def encode(self, value, _id, before: bool = False) -> str:
+        if self.field == 'modified':
+            value = value.isoformat()
+        payload = json.dumps([self.ordering, value, str(_id), before])
+        return base64.urlsafe_b64encode(payload.encode()).decode()
+
+    def decode(self, cursor: str) -> Tuple:
+        try:
+            ordering, value, _id, before = json.loads(
+                base64.urlsafe_b64decode(cursor.encode())
+            )
+        except (ValueError, TypeError, binascii.Error):
+            raise Http404('Invalid cursor')
+        if ordering != self.ordering:
+            raise Http404('Cursor of another ordering')
+        try:
+            _id = uuid.UUID(_id)
+            if self.field == 'modified':
+                value = parse_datetime(value)
+        except (ValueError, TypeError, AttributeError):
+            raise Http404('Invalid cursor')
+        if not isinstance(value, str if self.field == 'title' else datetime):
+            raise Http404('Invalid cursor')
+        return value, _id, bool(before)
+
+    def get_page_ids(self, cursor: Optional[str]) -> Tuple[List, Dict]:
+        """Find ids of the page and the cursors of its neighbours"""
+        before = False
+        queryset = Filmwork.objects.all()
+        if cursor:
+            value, _id, before = self.decode(cursor)
+            lookup = 'lt' if self.descending != before else 'gt'
+            queryset = queryset.filter(
+                Q(**{f'{self.field}__{lookup}': value})
+                | Q(**{self.field: value, f'id__{lookup}': _id})
+            )
+
+        order = ['-' + self.field, '-id'] if self.descending != before \
+            else [self.field, 'id']
+        rows = list(
+            queryset.order_by(*order)
+            .values_list(self.field, 'id')[:self.per_page + 1]
+        )
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if before:
+            rows.reverse()
+
+        has_next = bool(cursor) if before else has_more
+        has_prev = has_more if before else bool(cursor)
+        cursors = {
+            'next': self.encode(*rows[-1]) if rows and has_next else None,
+            'prev': self.encode(*rows[0], before=True)
+            if rows and has_prev else None,
+        }
+        return [_id for _, _id in rows], cursors
+
+    def paginate(self, queryset, cursor: Optional[str]) -> Tuple[List, Dict]:
+        """Aggregate only the movies of the page, in the page order"""
+        ids, cursors = self.get_page_ids(cursor)
+        order = ['-' + self.field, '-id'] if self.descending \
+            else [self.field, 'id']
+        results = list(queryset.filter(id__in=ids).order_by(*order))
+        return results, cursors
@@ -0,0 +1,43 @@
+import asyncio
+from typing import Optional, Tuple
+
+import asyncpg
+from django.conf import settings
+
+pool: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Task]] = None
+
+
+async def create_pool() -> asyncpg.Pool:
+    database = settings.DATABASES['default']
+    return await asyncpg.create_pool(
+        host=database['HOST'],
+        port=int(database['PORT']),
+        user=database['USER'],
+        password=database['PASSWORD'],
+        database=database['NAME'],
+        min_size=settings.MOVIES_API_DB_POOL_MIN_SIZE,
+        max_size=settings.MOVIES_API_DB_POOL_MAX_SIZE,
+        server_settings={'search_path': 'public,content'},
+    )
+
+
+async def get_pool() -> asyncpg.Pool:
+    """
+    Get the connection pool of the running event loop.
+    The ASGI server keeps a single loop, so connections are opened once
+    and reused by every request. A pool is bound to its loop and under
+    WSGI every request runs in a loop of its own, so the async views are
+    served only by uvicorn (the app-async service).
+    Concurrent first requests wait for the same pool to be created.
+    """
+    global pool
+
+    loop = asyncio.get_running_loop()
+    if pool is None or pool[0] is not loop or is_failed(pool[1]):
+        pool = (loop, loop.create_task(create_pool()))
+    return await pool[1]
+
+
+def is_failed(task: asyncio.Task) -> bool:
+    """Creation of the pool failed, the next request should try again"""
+    return task.done() and (task.cancelled() or task.exception() is not None)
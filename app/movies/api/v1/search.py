@@ -0,0 +1,112 @@
+import logging
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from elasticsearch import ApiError, Elasticsearch, TransportError
+
+logger = logging.getLogger(__name__)
+
+# Deeper pages are not served by elasticsearch (index.max_result_window)
+MAX_RESULT_WINDOW = 10000
+SORT_FIELDS = {
+    'title': 'title.raw',
+    'rating': 'imdb_rating',
+}
+
+
+class SearchUnavailable(Exception):
+    pass
+
+
+@lru_cache(maxsize=None)
+def get_client() -> Elasticsearch:
+    return Elasticsearch(settings.MOVIES_API_ES_DSN,
+                         request_timeout=settings.MOVIES_API_ES_TIMEOUT,
+                         max_retries=0)
+
+
+class MoviesSearch:
+    """
+    Search of the movies API over the movies index, it finds ids of
+    movies, which are read from Postgres then.
+    After a failure elasticsearch is not asked again for
+    MOVIES_API_ES_RETRY_AFTER seconds, SearchUnavailable is raised at once,
+    so the views fall back to Postgres without waiting for timeouts.
+    """
+    unavailable_until = 0.0
+
+    def __init__(self, index: Optional[str] = None):
+        self.index = index or settings.MOVIES_API_ES_INDEX
+
+    @classmethod
+    def is_available(cls) -> bool:
+        return settings.MOVIES_API_ELASTICSEARCH and \
+            time.monotonic() >= cls.unavailable_until
+
+    def call(self, method: str, **kwargs) -> Dict:
+        if not self.is_available():
+            raise SearchUnavailable()
+        try:
+            return getattr(get_client(), method)(index=self.index, **kwargs)
+        except (TransportError, ApiError) as e:
+            if isinstance(e, ApiError) and e.meta.status < 500 \
+                    and e.meta.status != 429:
+                raise
+            logger.warning(f'Elasticsearch is unavailable: {e}')
+            MoviesSearch.unavailable_until = \
+                time.monotonic() + settings.MOVIES_API_ES_RETRY_AFTER
+            raise SearchUnavailable() from e
+
+    @staticmethod
+    def build_query(params: Dict) -> Dict:
+        must, filters = [], []
+        if params.get('query'):
+            must.append({'multi_match': {
+                'query': params['query'],
+                'fields': ['title^3', 'description'],
+            }})
+        if params.get('genre'):
+            filters.append({'term': {'genre': params['genre']}})
+        if params.get('person'):
+            filters.append({'multi_match': {
+                'query': params['person'],
+                'type': 'phrase',
+                'fields': ['director', 'actors_names', 'writers_names'],
+            }})
+        rating = {
+            lookup: params[param]
+            for param, lookup in (('rating_from', 'gte'), ('rating_to', 'lte'))
+            if params.get(param) is not None
+        }
+        if rating:
+            filters.append({'range': {'imdb_rating': rating}})
+        if not must and not filters:
+            return {'match_all': {}}
+        return {'bool': {'must': must, 'filter': filters}}
+
+    @staticmethod
+    def build_sort(sort: Optional[str]) -> List:
+        if not sort:
+            return ['_score', 'id']
+        field = SORT_FIELDS[sort.lstrip('-')]
+        order = 'desc' if sort.startswith('-') else 'asc'
+        return [{field: order}, 'id']
+
+    def search(self, params: Dict, page: int,
+               per_page: int) -> Tuple[int, List[str]]:
+        """Find ids of a page of movies and the total of matching ones"""
+        if page * per_page > MAX_RESULT_WINDOW:
+            raise SearchUnavailable()
+        response = self.call(
+            'search',
+            query=self.build_query(params),
+            sort=self.build_sort(params.get('sort')),
+            from_=(page - 1) * per_page,
+            size=per_page,
+            track_total_hits=True,
+            source=False,
+        )
+        hits = response['hits']
+        return hits['total']['value'], [hit['_id'] for hit in hits['hits']]
@@ -1,8 +1,11 @@
 from django.urls import path
 
-from movies.api.v1 import views
+from movies.api.v1 import async_views, views
 
 urlpatterns = [
     path('movies/', views.MoviesListApi.as_view()),
-    path('movies/<uuid:pk>/', views.MoviesDetailApi.as_view())
+    path('movies/export/', views.MoviesExportApi.as_view()),
+    path('movies/<uuid:pk>/', views.MoviesDetailApi.as_view()),
+    path('async/movies/', async_views.movies_list),
+    path('async/movies/<uuid:pk>/', async_views.movies_detail),
 ]
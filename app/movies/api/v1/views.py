@@ -1,11 +1,33 @@
+import csv
+import json
+import math
+import re
+import time
+from datetime import datetime
+from itertools import islice
+
+from django.conf import settings
 from django.contrib.postgres.aggregates import ArrayAgg
+from django.core.paginator import Paginator
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models import Q
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.text import compress_sequence
+from django.utils.timezone import is_naive, make_aware
+from django.views import View
 from django.views.generic.detail import BaseDetailView
 from django.views.generic.list import BaseListView
 
+from movies.api.v1.caching import CachedResponseMixin
+from movies.api.v1.pagination import (CountedPaginator, KeysetPaginator,
+                                      get_movies_count)
+from movies.api.v1.search import SORT_FIELDS, MoviesSearch, SearchUnavailable
 from movies.models import Filmwork, RoleType
 
+ACCEPTS_GZIP = re.compile(r'\bgzip\b')
+
 
 class MoviesApiMixin:
     model = Filmwork
@@ -14,7 +36,8 @@ class MoviesApiMixin:
     def get_queryset(self):
         base_query = self.model.objects.prefetch_related('genres', 'persons')
         query = base_query.values().annotate(
-            genres=ArrayAgg('genres__name', distinct=True),
+            genres=ArrayAgg('genres__name',
+                            filter=Q(genres__isnull=False), distinct=True),
             actors=self.get_role_array(RoleType.ACTOR),
             directors=self.get_role_array(RoleType.DIRECTOR),
             writers=self.get_role_array(RoleType.WRITER)
@@ -32,11 +55,34 @@ class MoviesApiMixin:
         return JsonResponse(context)
 
 
-class MoviesListApi(MoviesApiMixin, BaseListView):
+class MoviesListApi(CachedResponseMixin, MoviesApiMixin, BaseListView):
+    """
+    Movies by pages.
+    Pages are numbered by default, with a cursor parameter (empty for
+    the first page) they are found by keyset pagination instead, ordered
+    by the ordering parameter.
+    Numbered pages can be searched by query, filtered by genre, person and
+    rating and sorted, by default they are ordered by id. Elasticsearch
+    finds the movies of a page when it is enabled and available, the
+    movies themselves are always read from Postgres, so they have the same
+    fields either way.
+    """
     paginate_by = 50
+    paginator_class = CountedPaginator
 
     def get_context_data(self, *, object_list=None, **kwargs):
         queryset = self.get_queryset()
+        if 'cursor' in self.request.GET:
+            return self.get_keyset_context_data(queryset)
+
+        self.search_params = self.get_search_params()
+        if self.is_search_available():
+            try:
+                return self.get_search_context_data(self.search_params)
+            except SearchUnavailable:
+                pass
+
+        queryset = self.filter_queryset(queryset, self.search_params)
         paginator, page, _, _ = self.paginate_queryset(
             queryset,
             self.paginate_by
@@ -50,8 +96,211 @@ class MoviesListApi(MoviesApiMixin, BaseListView):
         }
         return context
 
+    def get_paginator(self, queryset, per_page, **kwargs):
+        if self.search_params:
+            return Paginator(queryset, per_page, **kwargs)
+        return super().get_paginator(queryset, per_page, **kwargs)
+
+    def get_search_params(self):
+        params = {
+            name: self.request.GET[name]
+            for name in ('query', 'genre', 'person', 'sort')
+            if self.request.GET.get(name)
+        }
+        for name in ('rating_from', 'rating_to'):
+            if self.request.GET.get(name):
+                try:
+                    params[name] = float(self.request.GET[name])
+                except ValueError:
+                    raise Http404(f'Invalid {name}')
+        if params.get('sort', '').lstrip('-') not in ('', *SORT_FIELDS):
+            raise Http404(f'Invalid sort "{params["sort"]}"')
+        return params
+
+    def filter_queryset(self, queryset, params):
+        if params.get('query'):
+            queryset = queryset.filter(
+                Q(title__icontains=params['query'])
+                | Q(description__icontains=params['query'])
+            )
+        if params.get('genre'):
+            queryset = queryset.filter(id__in=self.model.objects.filter(
+                genres__name=params['genre']
+            ).values('id'))
+        if params.get('person'):
+            queryset = queryset.filter(id__in=self.model.objects.filter(
+                persons__full_name__icontains=params['person']
+            ).values('id'))
+        if 'rating_from' in params:
+            queryset = queryset.filter(rating__gte=params['rating_from'])
+        if 'rating_to' in params:
+            queryset = queryset.filter(rating__lte=params['rating_to'])
+        if params.get('sort'):
+            return queryset.order_by(params['sort'], 'id')
+        return queryset.order_by('id')
+
+    def is_search_available(self):
+        """
+        Elasticsearch is not asked for MOVIES_API_ES_LAG seconds after
+        a catalog change, until the ETL has indexed it, so its stale
+        results are not cached under the new generation.
+        """
+        generation = getattr(self, 'generation', None)
+        if generation is not None and \
+                time.time() - generation < settings.MOVIES_API_ES_LAG:
+            return False
+        return MoviesSearch.is_available()
+
+    def get_search_context_data(self, params):
+        try:
+            page = int(self.request.GET.get('page', 1))
+        except ValueError:
+            raise Http404('Invalid page')
+        count, ids = MoviesSearch().search(params, page, self.paginate_by)
+        total_pages = max(1, math.ceil(count / self.paginate_by))
+        if not 1 <= page <= total_pages:
+            raise Http404('Invalid page')
+        return {
+            'count': count,
+            'total_pages': total_pages,
+            'prev': page - 1 if page > 1 else None,
+            'next': page + 1 if page < total_pages else None,
+            'results': self.get_movies(ids),
+        }
+
+    def get_movies(self, ids):
+        """Movies of the ids in their order, missing ones are skipped"""
+        movies = {
+            str(movie['id']): movie
+            for movie in self.get_queryset().filter(id__in=ids)
+        }
+        return [movies[_id] for _id in ids if _id in movies]
+
+    def get_keyset_context_data(self, queryset):
+        paginator = KeysetPaginator(
+            self.paginate_by, self.request.GET.get('ordering', 'modified')
+        )
+        results, cursors = paginator.paginate(
+            queryset, self.request.GET['cursor']
+        )
+        return {
+            'count': get_movies_count(),
+            'prev': cursors['prev'],
+            'next': cursors['next'],
+            'results': results,
+        }
 
-class MoviesDetailApi(MoviesApiMixin, BaseDetailView):
+
+class MoviesDetailApi(CachedResponseMixin, MoviesApiMixin,
+                      BaseDetailView):
 
     def get_context_data(self, **kwargs):
         return super().get_context_data(**kwargs)['object']
+
+
+class Echo:
+    """File-like object returning what is written to it, for csv.writer"""
+
+    def write(self, value):
+        return value
+
+
+class MoviesExportApi(MoviesApiMixin, View):
+    """
+    The whole catalog in the shape of the API, as NDJSON or CSV.
+    Movies are read from a server-side cursor and streamed in batches,
+    so memory does not grow with the catalog. The response is gzipped
+    for clients accepting it, modified_since exports only movies changed
+    since the given date or time, their own fields or their persons
+    and genres, as the ETL finds them.
+    """
+    FORMATS = {
+        'ndjson': ('application/x-ndjson', 'movies.ndjson'),
+        'csv': ('text/csv', 'movies.csv'),
+    }
+    chunk_size = 2000
+    batch_size = 500
+
+    def get(self, request, *args, **kwargs):
+        export_format = request.GET.get('format', 'ndjson')
+        if export_format not in self.FORMATS:
+            raise Http404(f'Invalid format "{export_format}"')
+
+        queryset = self.get_queryset().order_by('id')
+        if request.GET.get('modified_since'):
+            queryset = self.filter_modified(queryset,
+                                            self.get_modified_since())
+        movies = queryset.iterator(chunk_size=self.chunk_size)
+        if export_format == 'csv':
+            columns = [*queryset.query.values_select,
+                       *queryset.query.annotation_select]
+            lines = self.to_csv(movies, columns)
+        else:
+            lines = self.to_ndjson(movies)
+        content = self.batch(lines)
+
+        content_type, filename = self.FORMATS[export_format]
+        response = StreamingHttpResponse(content, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if ACCEPTS_GZIP.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+            response.streaming_content = compress_sequence(
+                response.streaming_content
+            )
+            response['Content-Encoding'] = 'gzip'
+        return response
+
+    def get_modified_since(self):
+        value = self.request.GET['modified_since']
+        try:
+            modified_since = parse_datetime(value)
+            if modified_since is None:
+                modified_since = parse_date(value)
+                if modified_since is not None:
+                    modified_since = datetime.combine(
+                        modified_since, datetime.min.time()
+                    )
+        except ValueError:
+            modified_since = None
+        if modified_since is None:
+            raise Http404(f'Invalid modified_since "{value}"')
+        if is_naive(modified_since):
+            modified_since = make_aware(modified_since)
+        return modified_since
+
+    def filter_modified(self, queryset, modified_since):
+        persons_changed = self.model.objects.filter(
+            persons__modified__gte=modified_since
+        ).values('id')
+        genres_changed = self.model.objects.filter(
+            genres__modified__gte=modified_since
+        ).values('id')
+        return queryset.filter(
+            Q(modified__gte=modified_since)
+            | Q(id__in=persons_changed)
+            | Q(id__in=genres_changed)
+        )
+
+    def batch(self, lines):
+        """Join lines into bigger chunks, gzip flushes after every chunk"""
+        while True:
+            lines_batch = list(islice(lines, self.batch_size))
+            if not lines_batch:
+                return
+            yield ''.join(lines_batch)
+
+    @staticmethod
+    def to_ndjson(movies):
+        for movie in movies:
+            yield json.dumps(movie, cls=DjangoJSONEncoder) + '\n'
+
+    @staticmethod
+    def to_csv(movies, columns):
+        writer = csv.writer(Echo())
+        yield writer.writerow(columns)
+        for movie in movies:
+            yield writer.writerow([
+                ', '.join(str(item) for item in value if item is not None)
+                if isinstance(value, list) else value
+                for value in (movie[column] for column in columns)
+            ])
@@ -8,4 +8,4 @@ class MoviesConfig(AppConfig):
     verbose_name = _('movies')
 
     def ready(self):
-        pass
+        from movies import signals  # noqa: F401
@@ -0,0 +1,82 @@
+import json
+from contextlib import closing
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ('Benchmark full and incremental ETL runs on a synthetic catalog '
+            'against a local stand-in of elasticsearch. Needs a dedicated '
+            'database in ETL_BENCHMARK_DB_DSN and a state namespace in '
+            'ETL_BENCHMARK_NAMESPACE')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--generate',
+            type=int,
+            default=0,
+            help='Generate a catalog of that many film works first',
+        )
+        parser.add_argument(
+            '--cast-size',
+            type=int,
+            default=10,
+            help='Number of persons of every generated film work',
+        )
+        parser.add_argument(
+            '--genres-per-film',
+            type=int,
+            default=3,
+            help='Number of genres of every generated film work',
+        )
+        parser.add_argument(
+            '--changed',
+            type=float,
+            default=0.01,
+            help='Share of film works changed before incremental runs',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='Number of runs of every mode',
+        )
+        parser.add_argument(
+            '--bulk-latency',
+            type=float,
+            default=0,
+            help='Seconds the stand-in waits before answering a bulk',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Seed of the generated catalog and its changes',
+        )
+
+    def handle(self, *args, **options):
+        import psycopg2
+        from psycopg2.extras import DictCursor
+
+        from benchmark import (BenchmarkConfigError, benchmark_etl,
+                               generate_catalog, get_benchmark_target)
+
+        try:
+            dsn, namespace = get_benchmark_target()
+        except BenchmarkConfigError as e:
+            raise CommandError(str(e))
+
+        psycopg2.extras.register_uuid()
+        with closing(psycopg2.connect(dsn, cursor_factory=DictCursor)) as conn:
+            if options['generate']:
+                generate_catalog(conn, options['generate'],
+                                 cast_size=options['cast_size'],
+                                 genres_per_film=options['genres_per_film'],
+                                 seed=options['seed'])
+            results = benchmark_etl(conn, dsn, namespace, options['repeat'],
+                                    options['changed'],
+                                    options['bulk_latency'],
+                                    options['seed'])
+
+        for result in results:
+            self.stdout.write(json.dumps(result))
@@ -0,0 +1,43 @@
+from contextlib import closing
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ('Compare building of film work documents by SQL aggregation '
+            'and by application-side join')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pages',
+            type=int,
+            default=10,
+            help='Number of pages of film works to build',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='Number of runs of every path',
+        )
+        parser.add_argument(
+            '--cache-size',
+            type=int,
+            default=0,
+            help='Size of name caches, 0 loads all names',
+        )
+
+    def handle(self, *args, **options):
+        import psycopg2.extras
+
+        from benchmark import benchmark_join
+        from config.settings import settings
+        from postgres import PostgresConnection
+
+        psycopg2.extras.register_uuid()
+        with closing(PostgresConnection(settings.DB_DSN)) as conn:
+            timings = benchmark_join(conn, options['pages'],
+                                     options['repeat'], options['cache_size'])
+
+        for name, elapsed in timings.items():
+            self.stdout.write(f'{name}: {elapsed:.3f}s')
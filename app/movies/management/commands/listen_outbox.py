@@ -0,0 +1,33 @@
+from contextlib import closing
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Synchronize film works changes from outbox to Elasticsearch'
+
+    def handle(self, *args, **options):
+        import psycopg2.extras
+
+        from config.settings import settings
+        from data_loader import ESLoader
+        from etl import redis_cache
+        from hashing import DocumentHashes
+        from outbox import Listener, OutboxConsumer
+        from postgres import PostgresConnection
+
+        psycopg2.extras.register_uuid()
+        with closing(Listener(settings.DB_DSN,
+                              OutboxConsumer.CHANNEL)) as listener, \
+                closing(PostgresConnection(settings.DB_DSN)) as conn:
+            loader = ESLoader(
+                document_hashes=DocumentHashes(redis_cache.redis_cache)
+            )
+            consumer = OutboxConsumer(
+                listener, conn, loader,
+                bunch_size=settings.ETL_OUTBOX_BUNCH_SIZE,
+                poll_timeout=settings.ETL_OUTBOX_POLL_TIMEOUT,
+                documents=settings.ETL_DOCUMENT_TABLE,
+                rendered=settings.ETL_RENDERED_BULK
+            )
+            consumer.run()
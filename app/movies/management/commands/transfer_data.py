@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Transfer film works from Postgres to Elasticsearch'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Reload all film works without change detection',
+        )
+        parser.add_argument(
+            '--parallel',
+            type=int,
+            metavar='SHARDS',
+            help='Reload all film works by SHARDS parallel processes',
+        )
+        parser.add_argument(
+            '--rebuild',
+            action='store_true',
+            help='Build a new index and switch the alias to it, '
+                 'requires --parallel',
+        )
+        parser.add_argument(
+            '--profile',
+            default='full',
+            choices=('full', 'compact'),
+            help='Mapping profile of the rebuilt index',
+        )
+
+    def handle(self, *args, **options):
+        if options['rebuild'] and not options['parallel']:
+            raise CommandError('--rebuild requires --parallel')
+
+        if options['parallel']:
+            from etl import exclusive_run
+            from reindex import blue_green_reindex, parallel_reindex
+
+            if options['rebuild']:
+                exclusive_run(blue_green_reindex)(options['parallel'],
+                                                  profile=options['profile'])
+            else:
+                exclusive_run(parallel_reindex)(options['parallel'])
+            return
+
+        from etl import transfer_data
+
+        transfer_data(full_reload=options['full'])
@@ -0,0 +1,101 @@
+from django.db import migrations
+
+OUTBOX_SQL = '''
+CREATE TABLE content.film_work_outbox (
+    id bigserial PRIMARY KEY,
+    film_work_id uuid NOT NULL,
+    created timestamp with time zone NOT NULL DEFAULT now()
+);
+
+CREATE FUNCTION content.outbox_film_work() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO content.film_work_outbox (film_work_id)
+    VALUES (COALESCE(NEW.id, OLD.id));
+    PERFORM pg_notify('film_work_outbox', '');
+    RETURN NULL;
+END
+$$;
+
+CREATE FUNCTION content.outbox_film_work_link() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO content.film_work_outbox (film_work_id)
+    SELECT DISTINCT changed.film_work_id
+    FROM (VALUES (NEW.film_work_id), (OLD.film_work_id))
+        AS changed(film_work_id)
+    WHERE changed.film_work_id IS NOT NULL;
+    PERFORM pg_notify('film_work_outbox', '');
+    RETURN NULL;
+END
+$$;
+
+CREATE FUNCTION content.outbox_person() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO content.film_work_outbox (film_work_id)
+    SELECT DISTINCT pfw.film_work_id
+    FROM content.person_film_work pfw
+    WHERE pfw.person_id = COALESCE(NEW.id, OLD.id);
+    PERFORM pg_notify('film_work_outbox', '');
+    RETURN NULL;
+END
+$$;
+
+CREATE FUNCTION content.outbox_genre() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO content.film_work_outbox (film_work_id)
+    SELECT DISTINCT gfw.film_work_id
+    FROM content.genre_film_work gfw
+    WHERE gfw.genre_id = COALESCE(NEW.id, OLD.id);
+    PERFORM pg_notify('film_work_outbox', '');
+    RETURN NULL;
+END
+$$;
+
+CREATE TRIGGER film_work_outbox
+AFTER INSERT OR DELETE OR UPDATE OF title, description, rating
+ON content.film_work
+FOR EACH ROW EXECUTE FUNCTION content.outbox_film_work();
+
+CREATE TRIGGER person_film_work_outbox
+AFTER INSERT OR UPDATE OR DELETE ON content.person_film_work
+FOR EACH ROW EXECUTE FUNCTION content.outbox_film_work_link();
+
+CREATE TRIGGER genre_film_work_outbox
+AFTER INSERT OR UPDATE OR DELETE ON content.genre_film_work
+FOR EACH ROW EXECUTE FUNCTION content.outbox_film_work_link();
+
+CREATE TRIGGER person_outbox
+AFTER UPDATE OF full_name ON content.person
+FOR EACH ROW EXECUTE FUNCTION content.outbox_person();
+
+CREATE TRIGGER genre_outbox
+AFTER UPDATE OF name ON content.genre
+FOR EACH ROW EXECUTE FUNCTION content.outbox_genre();
+'''
+
+DROP_OUTBOX_SQL = '''
+DROP TRIGGER genre_outbox ON content.genre;
+DROP TRIGGER person_outbox ON content.person;
+DROP TRIGGER genre_film_work_outbox ON content.genre_film_work;
+DROP TRIGGER person_film_work_outbox ON content.person_film_work;
+DROP TRIGGER film_work_outbox ON content.film_work;
+DROP FUNCTION content.outbox_genre();
+DROP FUNCTION content.outbox_person();
+DROP FUNCTION content.outbox_film_work_link();
+DROP FUNCTION content.outbox_film_work();
+DROP TABLE content.film_work_outbox;
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0004_filmwork_film_work_modified_idx'),
+    ]
+
+    operations = [
+        migrations.RunSQL(OUTBOX_SQL, DROP_OUTBOX_SQL),
+    ]
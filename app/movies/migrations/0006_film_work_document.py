@@ -0,0 +1,103 @@
+from django.db import migrations
+
+DOCUMENT_SQL = '''
+CREATE TABLE content.film_work_document (
+    id uuid PRIMARY KEY
+        REFERENCES content.film_work (id) ON DELETE CASCADE,
+    document jsonb NOT NULL,
+    modified timestamp with time zone NOT NULL DEFAULT now()
+);
+
+CREATE FUNCTION content.refresh_film_work_documents(fw_ids uuid[])
+RETURNS void
+LANGUAGE sql AS $$
+    INSERT INTO content.film_work_document (id, document)
+    SELECT
+        fw.id,
+        jsonb_build_object(
+            'title', fw.title,
+            'description', fw.description,
+            'imdb_rating', fw.rating,
+            'director', COALESCE(
+                ARRAY_AGG(DISTINCT p.full_name)
+                    FILTER (WHERE pfw.role = 'director'),
+                '{}'
+            ),
+            'actors_names', COALESCE(
+                ARRAY_AGG(DISTINCT p.full_name)
+                    FILTER (WHERE pfw.role = 'actor'),
+                '{}'
+            ),
+            'writers_names', COALESCE(
+                ARRAY_AGG(DISTINCT p.full_name)
+                    FILTER (WHERE pfw.role = 'writer'),
+                '{}'
+            ),
+            'actors', COALESCE(
+                jsonb_agg(
+                    DISTINCT jsonb_build_object('id', p.id,
+                                                'name', p.full_name)
+                ) FILTER (WHERE p.id IS NOT null AND pfw.role = 'actor'),
+                '[]'
+            ),
+            'writers', COALESCE(
+                jsonb_agg(
+                    DISTINCT jsonb_build_object('id', p.id,
+                                                'name', p.full_name)
+                ) FILTER (WHERE p.id IS NOT null AND pfw.role = 'writer'),
+                '[]'
+            ),
+            'genre', COALESCE(
+                ARRAY_AGG(DISTINCT g.name) FILTER (WHERE g.id IS NOT null),
+                '{}'
+            )
+        )
+    FROM content.film_work fw
+    LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+    LEFT JOIN content.person p ON p.id = pfw.person_id
+    LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+    LEFT JOIN content.genre g ON g.id = gfw.genre_id
+    WHERE fw.id = ANY(fw_ids)
+    GROUP BY fw.id
+    ON CONFLICT (id) DO UPDATE
+    SET document = EXCLUDED.document, modified = now()
+    WHERE film_work_document.document IS DISTINCT FROM EXCLUDED.document;
+$$;
+
+CREATE FUNCTION content.refresh_outbox_documents() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM content.refresh_film_work_documents(
+        ARRAY(SELECT DISTINCT film_work_id FROM inserted)
+    );
+    RETURN NULL;
+END
+$$;
+
+CREATE TRIGGER film_work_outbox_documents
+AFTER INSERT ON content.film_work_outbox
+REFERENCING NEW TABLE AS inserted
+FOR EACH STATEMENT EXECUTE FUNCTION content.refresh_outbox_documents();
+
+SELECT content.refresh_film_work_documents(
+    ARRAY(SELECT id FROM content.film_work)
+);
+'''
+
+DROP_DOCUMENT_SQL = '''
+DROP TRIGGER film_work_outbox_documents ON content.film_work_outbox;
+DROP FUNCTION content.refresh_outbox_documents();
+DROP FUNCTION content.refresh_film_work_documents(uuid[]);
+DROP TABLE content.film_work_document;
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0005_film_work_outbox'),
+    ]
+
+    operations = [
+        migrations.RunSQL(DOCUMENT_SQL, DROP_DOCUMENT_SQL),
+    ]
@@ -0,0 +1,28 @@
+import django.db.models.expressions
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0006_film_work_document'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='filmwork',
+            index=models.Index(
+                django.db.models.expressions.F('modified'),
+                django.db.models.expressions.F('id'),
+                name='film_work_modified_id_idx'
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='filmwork',
+            index=models.Index(
+                django.db.models.expressions.F('title'),
+                django.db.models.expressions.F('id'),
+                name='film_work_title_id_idx'
+            ),
+        ),
+    ]
@@ -153,6 +153,8 @@ class Filmwork(TimeStampedMixin, UUIDMixin):
             models.Index("title", name="film_work_title_idx"),
             models.Index("creation_date", name="film_work_creation_date_idx"),
             models.Index("modified", name="film_work_modified_idx"),
+            models.Index("modified", "id", name="film_work_modified_id_idx"),
+            models.Index("title", "id", name="film_work_title_id_idx"),
         ]
         verbose_name = _('movie')
         verbose_name_plural = _('movies')
@@ -0,0 +1,25 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from movies.api.v1.caching import bump_generation
+from movies.models import (Filmwork, Genre, GenreFilmwork, Person,
+                           PersonFilmwork)
+
+CATALOG_MODELS = (Filmwork, Genre, GenreFilmwork, Person, PersonFilmwork)
+
+
+# The generation is bumped after the commit, otherwise a concurrent request
+# could cache the data read before the commit under the new generation
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_catalog(sender, **kwargs):
+    if sender in CATALOG_MODELS:
+        transaction.on_commit(bump_generation)
+
+
+@receiver(m2m_changed, sender=Filmwork.genres.through)
+@receiver(m2m_changed, sender=Filmwork.persons.through)
+def invalidate_catalog_links(sender, action, **kwargs):
+    if action.startswith('post_'):
+        transaction.on_commit(bump_generation)
@@ -0,0 +1,83 @@
+import json
+import os
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from storage import JsonFileStorage
+
+
+class JsonFileStorageTest(SimpleTestCase):
+    """State is the snapshot with the journal replayed over it"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.file_path = os.path.join(self.directory, 'state.json')
+        self.journal_path = f'{self.file_path}.journal'
+
+    def get_storage(self, **kwargs) -> JsonFileStorage:
+        storage = JsonFileStorage(self.file_path, **kwargs)
+        self.addCleanup(
+            lambda: storage.journal and storage.journal.close()
+        )
+        return storage
+
+    def write(self, path: str, content: str) -> None:
+        with open(path, 'w') as file:
+            file.write(content)
+
+    def read(self, path: str) -> str:
+        with open(path) as file:
+            return file.read()
+
+    def test_journal_is_replayed_over_snapshot(self):
+        self.write(self.file_path, json.dumps({'a': 1, 'b': 1}))
+        self.write(self.journal_path,
+                   json.dumps({'a': 2}) + '\n' + json.dumps({'c': 3}) + '\n')
+
+        state = self.get_storage().retrieve_state()
+        self.assertEqual(state, {'a': 2, 'b': 1, 'c': 3})
+
+    def test_torn_last_line_is_dropped(self):
+        self.write(self.file_path, json.dumps({'a': 1}))
+        self.write(self.journal_path,
+                   json.dumps({'a': 2}) + '\n' + '{"a": 3, "b"')
+
+        storage = self.get_storage()
+        self.assertEqual(storage.retrieve_state(), {'a': 2})
+        # The good state is compacted, so the torn line is not replayed
+        # before records appended after it
+        self.assertEqual(json.loads(self.read(self.file_path)), {'a': 2})
+        self.assertEqual(self.read(self.journal_path), '')
+
+        storage.save_state({'b': 4})
+        state = self.get_storage().retrieve_state()
+        self.assertEqual(state, {'a': 2, 'b': 4})
+
+    def test_compaction_replaces_snapshot(self):
+        storage = self.get_storage(compact_every=2)
+        storage.save_state({'a': 1})
+        storage.save_state({'b': 2})
+
+        self.assertEqual(json.loads(self.read(self.file_path)),
+                         {'a': 1, 'b': 2})
+        self.assertEqual(self.read(self.journal_path), '')
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['state.json', 'state.json.journal'])
+
+    def test_failed_compaction_keeps_last_good_state(self):
+        self.write(self.file_path, json.dumps({'a': 1}))
+        storage = self.get_storage(compact_every=1)
+
+        with mock.patch('storage.json.dump', side_effect=OSError):
+            with self.assertRaises(OSError):
+                storage.save_state({'b': 2})
+
+        self.assertEqual(json.loads(self.read(self.file_path)), {'a': 1})
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['state.json', 'state.json.journal'])
+        state = self.get_storage().retrieve_state()
+        self.assertEqual(state, {'a': 1, 'b': 2})
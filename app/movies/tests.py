@@ -0,0 +1,64 @@
+import uuid
+from unittest import mock
+
+from django.test import RequestFactory, SimpleTestCase
+
+from movies.api.v1.search import MoviesSearch
+from movies.api.v1.views import MoviesListApi
+
+
+class MoviesQuerySet:
+    """Rows of the API queryset, filtered by ids as Postgres would do"""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def filter(self, id__in):
+        return [row for row in self.rows if str(row['id']) in id__in]
+
+
+class SearchShapeTest(SimpleTestCase):
+    """Movies found by elasticsearch are the rows Postgres serves"""
+
+    def setUp(self):
+        self.rows = [
+            {
+                'id': uuid.uuid4(),
+                'title': title,
+                'description': None,
+                'creation_date': None,
+                'rating': 7.9,
+                'type': 'movie',
+                'certificate': '',
+                'file_path': None,
+                'created': None,
+                'modified': None,
+                'genres': ['Drama'],
+                'actors': [],
+                'directors': [],
+                'writers': [],
+            }
+            for title in ('Crescent Star', 'Star Wars')
+        ]
+        self.view = MoviesListApi()
+        self.view.setup(RequestFactory().get('/api/v1/movies/',
+                                             {'query': 'star'}))
+        self.view.get_queryset = lambda: MoviesQuerySet(self.rows)
+
+    def search(self, ids):
+        with mock.patch.object(MoviesSearch, 'is_available',
+                               return_value=True), \
+                mock.patch.object(MoviesSearch, 'search',
+                                  return_value=(len(ids), ids)):
+            return self.view.get_context_data()
+
+    def test_results_are_postgres_rows(self):
+        ids = [str(row['id']) for row in reversed(self.rows)]
+        context = self.search(ids)
+        self.assertEqual(context['results'], list(reversed(self.rows)))
+
+    def test_missing_rows_are_skipped(self):
+        ids = [str(self.rows[0]['id']), str(uuid.uuid4())]
+        context = self.search(ids)
+        self.assertEqual(context['results'], self.rows[:1])
+        self.assertEqual(context['count'], 2)
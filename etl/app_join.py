@@ -0,0 +1,165 @@
+import logging
+from collections import OrderedDict, defaultdict
+from typing import Dict, Iterable, List, Optional
+
+from utils.backoff import backoff
+
+logger = logging.getLogger(__name__)
+
+
+class NameCache:
+    """
+    Names of persons or genres by id.
+    Without a size limit the whole dictionary is loaded once and then only
+    rows modified since the previous refresh are read. With a size limit
+    names are loaded on demand and the least recently used are evicted.
+    """
+
+    def __init__(self, connection, table: str, name_column: str,
+                 max_size: int = 0):
+        self.connection = connection
+        self.table = table
+        self.name_column = name_column
+        self.max_size = max_size
+        self.names: OrderedDict = OrderedDict()
+        self.refreshed_at: Optional[str] = None
+
+    def refresh(self) -> None:
+        """Load names modified since the previous refresh"""
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT now();')
+            refreshed_at = cursor.fetchone()[0]
+            if self.refreshed_at is None and self.max_size:
+                self.refreshed_at = refreshed_at
+                return
+
+            condition = 'TRUE'
+            if self.refreshed_at is not None:
+                condition = 'modified >= %(since)s'
+            cursor.execute(
+                f'SELECT id, {self.name_column} FROM content.{self.table} '
+                f'WHERE {condition};',
+                {'since': self.refreshed_at}
+            )
+            refreshed = 0
+            for _id, name in cursor:
+                if not self.max_size or _id in self.names:
+                    self.names[_id] = name
+                    refreshed += 1
+        self.refreshed_at = refreshed_at
+        logger.info(f'{refreshed} names of {self.table} were refreshed')
+
+    def resolve(self, ids: Iterable) -> Dict:
+        """Get names of the ids, missing ones are read in one query"""
+        if self.refreshed_at is None:
+            self.refresh()
+        ids = set(ids)
+        missing = [_id for _id in ids if _id not in self.names]
+        if missing:
+            self.names.update(self.fetch(missing))
+        if self.max_size:
+            for _id in ids:
+                if _id in self.names:
+                    self.names.move_to_end(_id)
+            while len(self.names) > max(self.max_size, len(ids)):
+                self.names.popitem(last=False)
+        return {_id: self.names[_id] for _id in ids if _id in self.names}
+
+    def fetch(self, ids: List) -> Dict:
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT id, {self.name_column} FROM content.{self.table} '
+                f'WHERE id = ANY(%(ids)s::uuid[]);',
+                {'ids': ids}
+            )
+            return dict(cursor.fetchall())
+
+
+class DocumentAssembler:
+    """
+    Build film work rows from flat link rows and cached names instead of
+    aggregating joined rows in Postgres.
+    Rows are assembled in the columns order of the aggregation query.
+    Queries of assemble are not retried on their own, since they run while
+    cursors of the extractor are open: they are retried by the extractor.
+    """
+    PERSON_ROLES = ('director', 'actor', 'writer')
+
+    def __init__(self, connection, cache_size: int = 0):
+        self.connection = connection
+        self.persons = NameCache(connection, 'person', 'full_name',
+                                 cache_size)
+        self.genres = NameCache(connection, 'genre', 'name', cache_size)
+
+    @backoff(logger=logger, policy='postgres')
+    def refresh(self) -> None:
+        self.persons.refresh()
+        self.genres.refresh()
+
+    def get_fw_query_pattern(self, condition: str):
+        pattern = f'''
+            SELECT fw.id, fw.title, fw.description, fw.rating
+            FROM content.film_work fw
+            WHERE {condition}
+            ORDER BY fw.id;
+        '''
+        columns = [
+            'id', 'title', 'description', 'imdb_rating', 'director',
+            'actors_names', 'writers_names', 'actors', 'writers', 'genre'
+        ]
+        return pattern, columns
+
+    def assemble(self, film_works: List) -> List:
+        fw_ids = [fw[0] for fw in film_works]
+        person_links = self.fetch_links(
+            'SELECT film_work_id, person_id, role '
+            'FROM content.person_film_work '
+            'WHERE film_work_id = ANY(%(fw_ids)s::uuid[]);',
+            fw_ids
+        )
+        genre_links = self.fetch_links(
+            'SELECT film_work_id, genre_id '
+            'FROM content.genre_film_work '
+            'WHERE film_work_id = ANY(%(fw_ids)s::uuid[]);',
+            fw_ids
+        )
+        person_names = self.persons.resolve(
+            link[1] for link in person_links
+        )
+        genre_names = self.genres.resolve(link[1] for link in genre_links)
+
+        persons = defaultdict(lambda: {role: set()
+                                       for role in self.PERSON_ROLES})
+        for fw_id, person_id, role in person_links:
+            if person_id in person_names and role in self.PERSON_ROLES:
+                persons[fw_id][role].add(person_id)
+        genres = defaultdict(set)
+        for fw_id, genre_id in genre_links:
+            if genre_id in genre_names:
+                genres[fw_id].add(genre_names[genre_id])
+
+        rows = []
+        for fw_id, title, description, rating in film_works:
+            roles = persons[fw_id]
+            actors = self.get_persons(roles['actor'], person_names)
+            writers = self.get_persons(roles['writer'], person_names)
+            rows.append((
+                fw_id, title, description, rating,
+                sorted({person_names[_id] for _id in roles['director']}),
+                sorted({person['name'] for person in actors}),
+                sorted({person['name'] for person in writers}),
+                actors,
+                writers,
+                sorted(genres[fw_id]),
+            ))
+        return rows
+
+    @staticmethod
+    def get_persons(ids: Iterable, names: Dict) -> List[Dict]:
+        return [{'id': str(_id), 'name': names[_id]}
+                for _id in sorted(ids, key=str)]
+
+    def fetch_links(self, query: str, fw_ids: List) -> List:
+        with self.connection.cursor() as cursor:
+            cursor.execute(query, {'fw_ids': fw_ids})
+            return [tuple(row) for row in cursor.fetchall()]
@@ -0,0 +1,347 @@
+import asyncio
+import json
+import logging
+import re
+from collections import deque
+from contextlib import nullcontext
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import asyncpg
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.helpers import BulkIndexError, async_streaming_bulk
+
+from data_extractor import BaseExtractor
+from data_loader import ESLoader, count_sent, get_retryable_actions
+from metrics import metrics
+from pipeline import transform
+from utils.backoff import backoff, get_policy
+
+logger = logging.getLogger(__name__)
+
+PARAMETER_PATTERN = re.compile(r'%\((\w+)\)s')
+
+
+def to_positional(query: str, params: Dict) -> Tuple[str, List]:
+    """Replace pyformat placeholders of a query with asyncpg positional ones"""
+    names = []
+
+    def replace(match):
+        name = match.group(1)
+        if name not in names:
+            names.append(name)
+        return f'${names.index(name) + 1}'
+
+    query = PARAMETER_PATTERN.sub(replace, query)
+    return query, [params[name] for name in names]
+
+
+class AsyncDataExtractor(BaseExtractor):
+    """
+    Extract changed film works with asyncpg.
+    The extractor shares the state, windows and checkpoints with
+    DataExtractor, so engines can be switched between runs.
+    """
+
+    def __init__(self, connection: 'AsyncPostgresConnection',
+                 full_reload: bool = False, window_hours: int = 0):
+        super().__init__(True, full_reload, window_hours)
+        self.connection = connection
+
+    async def extract(self) -> AsyncIterator[Tuple[List, List[str]]]:
+        if self.full_reload:
+            async for bunch in self.extract_full():
+                yield bunch
+            self.commit_full_reload()
+            return
+
+        for since, till in self.get_windows():
+            self.start_window(since, till)
+            async for bunch in self.extract_streaming():
+                yield bunch
+            self.commit_window()
+
+    async def extract_streaming(self) -> AsyncIterator[Tuple[List, List]]:
+        for entity in self.CHANGED_ENTITIES:
+            progress = self.get_progress(entity)
+            if progress == self.STAGE_DONE:
+                continue
+
+            extracted = 0
+            async for data, columns in self.iter_stage(entity, progress):
+                extracted += len(data)
+                self._track_bunch(self.get_bunch_checkpoint(entity, data))
+                yield data, columns
+            logger.info(f'{extracted} items changed by {entity} '
+                        f'were extracted')
+
+            self.commit_stage(entity)
+
+    async def extract_full(self) -> AsyncIterator[Tuple[List, List]]:
+        total = await self.count_film_works()
+        last_id = self.start_full_reload()
+        logger.info(f'Full reload of {total} film works was started')
+        if last_id:
+            logger.info(f'Full reload is resumed after film work {last_id}')
+
+        pattern, columns = self.get_fw_query_pattern(self.FW_PAGE_CONDITION)
+        extracted = 0
+        while data := await self.fetch_page(pattern, last_id):
+            extracted += len(data)
+            last_id = data[-1][0]
+            logger.info(f'{extracted}/{total} items were extracted')
+            self._track_bunch(
+                self.get_bunch_checkpoint(self.FULL_RELOAD_ENTITY, data)
+            )
+            yield data, columns
+
+    @backoff(logger=logger, policy='postgres')
+    async def count_film_works(self) -> int:
+        return await self.connection.fetchval(
+            'SELECT count(*) FROM content.film_work;'
+        )
+
+    @backoff(logger=logger, policy='postgres')
+    async def fetch_page(self, pattern: str, last_id) -> List:
+        query, args = to_positional(pattern, {
+            'last_id': last_id,
+            'lower_id': None,
+            'upper_id': None,
+            'limit': self.bunch_size,
+        })
+        with metrics.timer('aggregation'):
+            data = await self.connection.fetch(query, *args)
+        metrics.increment('rows_extracted', len(data))
+        return data
+
+    @backoff(logger=logger, policy='postgres',
+             resume=lambda bunch: {'after': bunch[0][-1][0]})
+    async def iter_stage(self, entity: str, after: Optional[str] = None
+                         ) -> AsyncIterator[Tuple[List, List[str]]]:
+        """
+        Film works changed by the entity in order of their ids, as
+        DataExtractor.iter_stage. Cursors are read in a transaction of
+        the stage, pages of a full reload are read without one, so a failed
+        query does not abort the transaction other queries are retried in.
+        """
+        async with self.connection.transaction():
+            async for fw_ids in self.iter_changed_fw_ids(entity, after):
+                async for bunch in self.fetch_film_works(fw_ids):
+                    yield bunch
+
+    async def iter_changed_fw_ids(
+            self, entity: str, after: Optional[str] = None
+    ) -> AsyncIterator[List]:
+        query, args = to_positional(self.get_changed_fw_ids_query(entity), {
+            'since': datetime.fromisoformat(self.since),
+            'till': datetime.fromisoformat(self.till),
+            'after': after,
+            'renamed': [],
+        })
+        cursor = await self.connection.cursor(query, *args)
+        while data := await self.fetch_many(cursor, 'change_detection'):
+            yield [fw[0] for fw in data]
+
+    async def fetch_film_works(
+            self, fw_ids: List
+    ) -> AsyncIterator[Tuple[List, List[str]]]:
+        pattern, columns = self.get_fw_query_pattern(self.FW_IDS_CONDITION)
+        query, args = to_positional(pattern, {'fw_ids': fw_ids,
+                                              'after': None})
+        cursor = await self.connection.cursor(query, *args)
+        while data := await self.fetch_many(cursor, 'aggregation'):
+            yield data, columns
+
+    async def fetch_many(self, cursor, stage: str) -> List:
+        with metrics.timer(stage):
+            data = await cursor.fetch(self.bunch_size)
+        metrics.increment('rows_extracted' if stage == 'aggregation'
+                          else 'changed_ids', len(data))
+        return data
+
+
+class AsyncESLoader(ESLoader):
+    def __init__(self, refresh=False, document_hashes=None):
+        from config.settings import settings
+
+        self.es = AsyncElasticsearch(settings.ES_DSN)
+        self.refresh = refresh
+        self.existing_indices = set()
+        self.document_hashes = document_hashes
+        self.written = 0
+        self.skipped = 0
+
+    async def load(self, data: List[Dict],
+                   index_name: str = ESLoader.default_index_name):
+        actions, hashes = await asyncio.to_thread(self.prepare, data)
+        await self.send(actions, index_name, hashes)
+
+    async def send(self, actions: List[Dict],
+                   index_name: str = ESLoader.default_index_name,
+                   hashes: Optional[Dict] = None):
+        if actions:
+            await self.bulk(actions, index_name)
+            self.written += len(actions)
+            metrics.increment('documents_written', len(actions))
+        if self.document_hashes is not None and hashes:
+            # The hashes are kept by the synchronous Redis client, it must
+            # not block bulks in flight
+            await asyncio.to_thread(self.document_hashes.save, hashes)
+
+    async def bulk(self, actions: List[Dict],
+                   index_name: str = ESLoader.default_index_name):
+        policy = get_policy('elasticsearch')
+        attempt = 0
+        while actions:
+            failed = await self.send_bulk(actions, index_name)
+            actions = get_retryable_actions(failed)
+            if not actions:
+                break
+            sleep_time = policy.get_sleep_time(attempt)
+            if sleep_time is None:
+                raise BulkIndexError(
+                    f'{len(actions)} document(s) were rejected', failed
+                )
+            logger.info(f'{len(actions)} rejected documents will be resent')
+            metrics.increment('documents_resent', len(actions))
+            await asyncio.sleep(sleep_time)
+            attempt += 1
+
+    @backoff(logger=logger, policy='elasticsearch')
+    async def send_bulk(self, actions: List[Dict],
+                        index_name: str = ESLoader.default_index_name
+                        ) -> List[Tuple]:
+        await self.ensure_index(index_name)
+        count_sent(actions)
+        results = async_streaming_bulk(
+            self.es, actions, index=index_name, refresh=self.refresh,
+            raise_on_error=False
+        )
+        failed = []
+        position = 0
+        with metrics.timer('bulk'):
+            async for ok, result in results:
+                if not ok:
+                    failed.append((actions[position], result))
+                position += 1
+        return failed
+
+    async def ensure_index(self,
+                           index_name: str = ESLoader.default_index_name):
+        if index_name in self.existing_indices:
+            return
+        if not await self.es.indices.exists(index=index_name):
+            await asyncio.to_thread(ESLoader().ensure_index, index_name)
+        self.existing_indices.add(index_name)
+
+    @backoff(logger=logger, policy='elasticsearch')
+    async def create_index(self,
+                           index_name: str = ESLoader.default_index_name,
+                           settings: Optional[Dict] = None,
+                           mappings: Optional[Dict] = None):
+        await self.es.indices.create(
+            index=index_name, ignore=400,
+            body=self.get_index_body(settings, mappings)
+        )
+        logger.info(f'Index "{index_name}" was created')
+
+    @backoff(logger=logger, policy='elasticsearch')
+    async def search(self, search: Dict,
+                     index: str = ESLoader.default_index_name, **kwargs):
+        return await self.es.search(index=index, body=search, **kwargs)
+
+    async def close(self):
+        await self.es.close()
+
+
+async def connect(dsn: str) -> asyncpg.Connection:
+    connection = await asyncpg.connect(dsn)
+    for json_type in ('json', 'jsonb'):
+        await connection.set_type_codec(
+            json_type, encoder=json.dumps, decoder=json.loads,
+            schema='pg_catalog'
+        )
+    return connection
+
+
+class AsyncPostgresConnection:
+    """
+    asyncpg connection which is opened again before a failed call is
+    retried if it was lost, see utils.backoff.recover_connection.
+    Aborted transactions are rolled back by their context managers.
+    Other attributes are those of the current asyncpg connection.
+    """
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.raw: Optional[asyncpg.Connection] = None
+
+    async def connect(self) -> None:
+        self.raw = await connect(self.dsn)
+
+    async def recover(self) -> None:
+        if not self.raw.is_closed():
+            return
+        logger.warning('Connection to Postgres was lost, it is opened again')
+        try:
+            await self.connect()
+        except (OSError, asyncio.TimeoutError,
+                asyncpg.PostgresConnectionError) as e:
+            # The next attempt fails on the closed connection and
+            # recovers it once more
+            logger.warning(f'Connection to Postgres was not recovered: {e}')
+
+    def __getattr__(self, name: str):
+        return getattr(self.raw, name)
+
+
+async def transfer_data(full_reload: bool = False,
+                        document_hashes=None) -> AsyncESLoader:
+    """
+    Transfer changed film works keeping several bulk requests in flight
+    while next bunches are fetched. Bunches are acknowledged in order.
+    """
+    from config.settings import settings
+
+    connection = AsyncPostgresConnection(settings.DB_DSN)
+    await connection.connect()
+    loader = AsyncESLoader(document_hashes=document_hashes)
+    in_flight = deque()
+    try:
+        extractor = AsyncDataExtractor(connection, full_reload,
+                                       settings.ETL_WINDOW_HOURS)
+        ingestion = nullcontext()
+        if extractor.full_reload:
+            loader.document_hashes = None
+            ingestion = ESLoader().ingestion(
+                force_merge=settings.ETL_FORCE_MERGE
+            )
+        with ingestion:
+            await send_bunches(extractor, loader, in_flight,
+                               settings.ETL_MAX_IN_FLIGHT)
+        if extractor.full_reload and document_hashes is not None:
+            document_hashes.clear()
+        return loader
+    finally:
+        for task in in_flight:
+            task.cancel()
+        await loader.close()
+        await connection.close()
+
+
+async def send_bunches(extractor: AsyncDataExtractor, loader: AsyncESLoader,
+                       in_flight: deque, max_in_flight: int) -> None:
+    async for data, columns in extractor.extract():
+        actions, hashes = await asyncio.to_thread(
+            loader.prepare, transform(data, columns)
+        )
+        in_flight.append(
+            asyncio.create_task(loader.send(actions, hashes=hashes))
+        )
+        while len(in_flight) > max_in_flight:
+            await in_flight.popleft()
+            extractor.acknowledge()
+
+    while in_flight:
+        await in_flight.popleft()
+        extractor.acknowledge()
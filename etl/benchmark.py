@@ -0,0 +1,423 @@
+import json
+import logging
+import random
+import resource
+import statistics
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import islice
+from typing import Dict, Iterator, List, Tuple
+
+from elasticsearch import Elasticsearch
+from psycopg2.extras import execute_values
+
+from app_join import DocumentAssembler
+from data_extractor import DataExtractor
+from data_loader import ESLoader
+from etl import state
+from metrics import metrics
+from pipeline import transform
+
+logger = logging.getLogger(__name__)
+
+GENERATE_PAGE_SIZE = 1000
+ROLES = ('actor', 'actor', 'actor', 'writer', 'director')
+WORDS = (
+    'story', 'city', 'night', 'war', 'love', 'space', 'family', 'secret',
+    'journey', 'king', 'river', 'ghost', 'summer', 'island', 'machine',
+    'winter', 'detective', 'dream', 'empire', 'stranger',
+)
+
+
+class BenchmarkConfigError(Exception):
+    pass
+
+
+def get_benchmark_target() -> Tuple[str, str]:
+    """
+    Get the database and the state namespace of the benchmark.
+    The benchmark rewrites its catalog and checkpoints, so both have to be
+    dedicated ones, the production database and state are refused.
+    """
+    from config.settings import settings
+
+    dsn = settings.ETL_BENCHMARK_DB_DSN
+    namespace = settings.ETL_BENCHMARK_NAMESPACE
+    if not dsn or dsn == settings.DB_DSN:
+        raise BenchmarkConfigError(
+            'Set ETL_BENCHMARK_DB_DSN to a dedicated benchmark database'
+        )
+    if not namespace or namespace == state.storage.namespace:
+        raise BenchmarkConfigError(
+            'Set ETL_BENCHMARK_NAMESPACE to a dedicated state namespace'
+        )
+    return dsn, namespace
+
+
+def normalize(document: Dict) -> Dict:
+    """Drop ordering and null differences between the transform paths"""
+    normalized = dict(document)
+    for field in ('actors', 'writers'):
+        normalized[field] = sorted(document[field],
+                                   key=lambda person: str(person['id']))
+    for field in ('director', 'actors_names', 'writers_names', 'genre'):
+        normalized[field] = sorted(
+            name for name in document[field] or [] if name is not None
+        )
+    return normalized
+
+
+def read_documents(extractor: DataExtractor, pages: int) -> List[Dict]:
+    documents = []
+    for data, columns in islice(extractor.iter_pages(), pages):
+        documents.extend(transform(data, columns))
+    return documents
+
+
+def benchmark_join(connection, pages: int = 10, repeat: int = 3,
+                   cache_size: int = 0) -> Dict[str, float]:
+    """
+    Compare the SQL aggregation with the application-side join on the same
+    first pages of film works. The best time of every path is returned,
+    documents of both paths are checked to be equal.
+    """
+    assembler = DocumentAssembler(connection, cache_size)
+    assembler.refresh()
+    paths = {'sql': None, 'app_join': assembler}
+
+    timings, documents = {}, {}
+    for name, path_assembler in paths.items():
+        extractor = DataExtractor(connection, assembler=path_assembler)
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            documents[name] = read_documents(extractor, pages)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+        logger.info(f'{len(documents[name])} documents were built by '
+                    f'{name} in {best:.3f}s')
+
+    mismatched = sum(
+        normalize(sql) != normalize(app)
+        for sql, app in zip(documents['sql'], documents['app_join'])
+    )
+    if mismatched or len(documents['sql']) != len(documents['app_join']):
+        logger.warning(f'{mismatched} documents differ between '
+                       f'the transform paths')
+    return timings
+
+
+class BulkStub:
+    """
+    In-process stand-in of the elasticsearch endpoints used by ESLoader.
+    Every index exists, bulk actions are parsed and acknowledged without
+    storing documents, so timings show the cost of the ETL itself.
+    """
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.requests = 0
+        self.documents = 0
+        self.bytes_received = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                          self.get_handler())
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address
+        return f'http://{host}:{port}'
+
+    def __enter__(self) -> 'BulkStub':
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.requests = self.documents = self.bytes_received = 0
+
+    def bulk(self, body: bytes) -> Dict:
+        items = []
+        lines = iter(body.splitlines())
+        for line in lines:
+            if not line.strip():
+                continue
+            (op_type, meta), = json.loads(line).items()
+            if op_type != 'delete':
+                next(lines, None)
+            items.append({op_type: {
+                '_index': meta.get('_index'),
+                '_id': meta.get('_id'),
+                'status': 200,
+                'result': 'updated',
+            }})
+        with self.lock:
+            self.requests += 1
+            self.documents += len(items)
+            self.bytes_received += len(body)
+        if self.latency:
+            time.sleep(self.latency)
+        return {'took': 0, 'errors': False, 'items': items}
+
+    def get_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def respond(self, body: Dict, send_body: bool = True) -> None:
+                content = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('X-Elastic-Product', 'Elasticsearch')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                if send_body:
+                    self.wfile.write(content)
+
+            def read_body(self) -> bytes:
+                length = int(self.headers.get('Content-Length') or 0)
+                return self.rfile.read(length)
+
+            def do_HEAD(self) -> None:
+                self.respond({}, send_body=False)
+
+            def do_GET(self) -> None:
+                path = self.path.split('?')[0].strip('/')
+                if path.endswith('_settings'):
+                    index = path.split('/')[0]
+                    self.respond({index: {'settings': {'index': {
+                        'refresh_interval': '1s',
+                        'number_of_replicas': '1',
+                    }}}})
+                elif path.endswith('_count'):
+                    self.respond({'count': stub.documents})
+                else:
+                    self.respond({'version': {'number': '8.2.2'}})
+
+            def do_POST(self) -> None:
+                body = self.read_body()
+                if self.path.split('?')[0].endswith('_bulk'):
+                    self.respond(stub.bulk(body))
+                else:
+                    self.respond({'acknowledged': True})
+
+            do_PUT = do_POST
+            do_DELETE = do_POST
+
+        return Handler
+
+
+@contextmanager
+def isolated_state(namespace: str) -> Iterator[None]:
+    """
+    Keep checkpoints of benchmark runs in their own namespace, away from
+    the real ETL state. Checkpoints of previous benchmarks are dropped.
+    """
+    storage = state.storage
+    state.storage = storage.with_namespace(namespace)
+    state.storage.redis_cache.unlink(namespace)
+    state.reset()
+    try:
+        yield
+    finally:
+        state.storage = storage
+        state.reset()
+
+
+def generate_catalog(connection, film_works: int = 10000,
+                     cast_size: int = 10, genres_per_film: int = 3,
+                     persons: int = 0, genres: int = 30,
+                     seed: int = 0) -> None:
+    """
+    Fill the content schema with a synthetic catalog.
+    The same arguments produce the same catalog, so runs on different
+    commits read identical data. Triggers of the content tables are
+    disabled while the catalog is inserted and rendered documents are
+    refreshed once afterwards.
+    """
+    rng = random.Random(seed)
+    persons = persons or max(film_works * cast_size // 5, cast_size)
+    genres = max(genres, genres_per_film)
+    now = datetime.now()
+
+    def new_id() -> uuid.UUID:
+        return uuid.UUID(int=rng.getrandbits(128), version=4)
+
+    genre_ids = [new_id() for _ in range(genres)]
+    person_ids = [new_id() for _ in range(persons)]
+    fw_ids = [new_id() for _ in range(film_works)]
+    tables = ('film_work', 'person', 'genre', 'person_film_work',
+              'genre_film_work')
+
+    with connection, connection.cursor() as cursor:
+        for table in tables:
+            cursor.execute(
+                f'ALTER TABLE content.{table} DISABLE TRIGGER USER;'
+            )
+        execute_values(
+            cursor,
+            'INSERT INTO content.genre (id, name, description, created, '
+            'modified) VALUES %s',
+            [(_id, f'Genre {number}', None, now, now)
+             for number, _id in enumerate(genre_ids)],
+            page_size=GENERATE_PAGE_SIZE
+        )
+        execute_values(
+            cursor,
+            'INSERT INTO content.person (id, full_name, created, modified) '
+            'VALUES %s',
+            [(_id, f'Person {number}', now, now)
+             for number, _id in enumerate(person_ids)],
+            page_size=GENERATE_PAGE_SIZE
+        )
+        for bunch in range(0, film_works, GENERATE_PAGE_SIZE):
+            bunch_ids = fw_ids[bunch:bunch + GENERATE_PAGE_SIZE]
+            execute_values(
+                cursor,
+                'INSERT INTO content.film_work (id, title, description, '
+                'creation_date, rating, type, created, modified) VALUES %s',
+                [(_id, f'Film {bunch + number}',
+                  ' '.join(rng.choices(WORDS, k=30)), now.date(),
+                  round(rng.uniform(0, 10), 1), 'movie', now, now)
+                 for number, _id in enumerate(bunch_ids)],
+                page_size=GENERATE_PAGE_SIZE
+            )
+            execute_values(
+                cursor,
+                'INSERT INTO content.person_film_work (id, film_work_id, '
+                'person_id, role, created) VALUES %s',
+                [(new_id(), fw_id, person_id, rng.choice(ROLES), now)
+                 for fw_id in bunch_ids
+                 for person_id in rng.sample(person_ids, cast_size)],
+                page_size=GENERATE_PAGE_SIZE
+            )
+            execute_values(
+                cursor,
+                'INSERT INTO content.genre_film_work (id, film_work_id, '
+                'genre_id, created) VALUES %s',
+                [(new_id(), fw_id, genre_id, now)
+                 for fw_id in bunch_ids
+                 for genre_id in rng.sample(genre_ids, genres_per_film)],
+                page_size=GENERATE_PAGE_SIZE
+            )
+        for table in tables:
+            cursor.execute(
+                f'ALTER TABLE content.{table} ENABLE TRIGGER USER;'
+            )
+        cursor.execute(
+            "SELECT to_regclass('content.film_work_document') IS NOT NULL;"
+        )
+        if cursor.fetchone()[0]:
+            cursor.execute(
+                'SELECT content.refresh_film_work_documents(%s::uuid[]);',
+                (fw_ids,)
+            )
+    logger.info(f'{film_works} film works, {persons} persons and '
+                f'{genres} genres were generated')
+
+
+def change_catalog(connection, share: float, seed: int = 0) -> int:
+    """
+    Touch a share of film works and persons for an incremental run.
+    Only modified is moved, the content of the catalog stays the same.
+    """
+    with connection, connection.cursor() as cursor:
+        cursor.execute('SELECT setseed(%s);', (seed / (2 ** 31),))
+        cursor.execute(
+            'UPDATE content.film_work SET modified = now() '
+            'WHERE random() < %s;', (share,)
+        )
+        changed = cursor.rowcount
+        cursor.execute(
+            'UPDATE content.person SET modified = now() '
+            'WHERE random() < %s;', (share / 10,)
+        )
+        return changed + cursor.rowcount
+
+
+def get_peak_rss_mb() -> float:
+    """Peak resident set size of the process, in megabytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024),
+                 1)
+
+
+def get_stub_loader(url: str) -> ESLoader:
+    """
+    Loader sending to BulkStub. A loader is built for every run, since
+    sync_transfer_data reconfigures the loader of a full reload.
+    """
+    loader = ESLoader()
+    loader.es = Elasticsearch(url)
+    return loader
+
+
+def run_etl(loader: ESLoader, full_reload: bool, dsn: str) -> Dict:
+    from etl import sync_transfer_data
+
+    metrics.reset()
+    state.set_state(DataExtractor.CURRENT_TIME_KEY,
+                    datetime.now().isoformat())
+    sync_transfer_data(full_reload, loader=loader, dsn=dsn)
+    return metrics.summary()
+
+
+def benchmark_etl(connection, dsn: str, namespace: str, repeat: int = 3,
+                  changed_share: float = 0.01, bulk_latency: float = 0,
+                  seed: int = 0) -> List[Dict]:
+    """
+    Run full and incremental loads of the catalog against BulkStub.
+    The connection and dsn lead to the benchmark database, checkpoints are
+    kept in the namespace, see get_benchmark_target.
+    Peak RSS is measured for the whole process, so it only grows between
+    runs. Returns results of every run with the median throughput.
+    """
+    results = []
+    with isolated_state(namespace), BulkStub(bulk_latency) as stub:
+        for mode in ('full', 'incremental'):
+            runs = []
+            for number in range(repeat):
+                if mode == 'incremental':
+                    change_catalog(connection, changed_share, seed + number)
+                stub.reset()
+                summary = run_etl(get_stub_loader(stub.url),
+                                  full_reload=mode == 'full', dsn=dsn)
+                summary.update({
+                    'mode': mode,
+                    'run': number,
+                    'documents': stub.documents,
+                    'bytes_received': stub.bytes_received,
+                    'bulk_requests': stub.requests,
+                    'peak_rss_mb': get_peak_rss_mb(),
+                })
+                runs.append(summary)
+                logger.info(f'{mode} run {number}: {stub.documents} '
+                            f'documents, {summary["documents_per_second"]} '
+                            f'documents/s')
+            results.extend(runs)
+            results.append({
+                'mode': mode,
+                'median_documents_per_second': statistics.median(
+                    run['documents_per_second'] for run in runs
+                ),
+                'median_duration_seconds': statistics.median(
+                    run['duration_seconds'] for run in runs
+                ),
+            })
+    return results
@@ -1,50 +1,211 @@
 import logging
-from datetime import datetime
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
 
 from etl import state
+from metrics import metrics
+from ndjson import RENDERED_COLUMNS
 from utils.backoff import backoff
 
 logger = logging.getLogger(__name__)
 
 
-class DataExtractor:
+class BaseExtractor:
+    """
+    Extraction state shared by the extraction engines: the watermark,
+    time windows and checkpoints of loaded bunches.
+    """
     CURRENT_TIME_KEY = 'current_time'
     LAST_EXTRACTED_KEY = 'last_extracted_time'
+    LAST_LOADED_FW_KEY = 'last_loaded_fw_id'
+    WINDOW_END_KEY = 'window_end'
+    FULL_RELOAD_STARTED_KEY = 'full_reload_started'
+    PROGRESS_KEY = 'progress_{entity}'
+    STAGE_DONE = 'done'
 
-    def __init__(self, connection):
+    FULL_RELOAD_ENTITY = 'full'
+    CHANGED_ENTITIES = ('film_work', 'person', 'genre')
+    PARTIAL_STAGE = '{entity}_partial'
+
+    FW_IDS_CONDITION = '''fw.id = ANY(%(fw_ids)s::uuid[])
+                AND (%(after)s::uuid IS NULL OR fw.id > %(after)s::uuid)'''
+    FW_PAGE_CONDITION = '''fw.id IN (
+                SELECT id
+                FROM content.film_work
+                WHERE (%(last_id)s::uuid IS NULL OR id > %(last_id)s::uuid)
+                    AND (%(lower_id)s::uuid IS NULL
+                         OR id >= %(lower_id)s::uuid)
+                    AND (%(upper_id)s::uuid IS NULL
+                         OR id < %(upper_id)s::uuid)
+                ORDER BY id
+                LIMIT %(limit)s
+            )'''
+
+    def __init__(self, streaming: bool = False, full_reload: bool = False,
+                 window_hours: int = 0):
         self.current_time = state.get_state(self.CURRENT_TIME_KEY)
         self.last_extracted_time = self.get_last_extracted_time()
-        self.cursor = connection.cursor()
+        self.since = self.last_extracted_time
+        self.till = self.current_time
         self.bunch_size = 5000
+        self.streaming = streaming
+        self.full_reload = full_reload or self.is_first_extraction()
+        self.full_reload_started = self.current_time
+        self.window_hours = window_hours
+
+        self._pending = deque()
+        self._pending_lock = threading.Lock()
 
     def get_last_extracted_time(self) -> str:
         extracted_time = state.get_state(self.LAST_EXTRACTED_KEY)
         return extracted_time if extracted_time else datetime.min.isoformat()
 
-    def extract(self):
-        fw_ids_persons_changed = self.get_fw_ids_persons_changed()
-        fw_ids_genres_changed = self.get_fw_ids_genres_changed()
-        film_work_changed = set()
-        for film_work_bunch in self.get_film_work_changed():
-            film_work_changed.update(film_work_bunch)
+    def is_first_extraction(self) -> bool:
+        return self.last_extracted_time == datetime.min.isoformat()
 
-        all_changed_fw_ids = (
-                fw_ids_persons_changed |
-                fw_ids_genres_changed |
-                film_work_changed
-        )
-        logger.info(f'{len(all_changed_fw_ids)} items were extracted')
+    def acknowledge(self) -> None:
+        """
+        Confirm that the oldest yielded bunch was loaded.
+        Saves the bunch checkpoint and every window commit that follows it.
+        """
+        with self._pending_lock:
+            _, checkpoint = self._pending.popleft()
+            state.set_states(checkpoint)
+            self._flush_commits()
 
-        if all_changed_fw_ids:
-            str_fw_ids = "', '".join([fw for fw in all_changed_fw_ids])
+    def _track_bunch(self, checkpoint: Dict) -> None:
+        with self._pending_lock:
+            self._pending.append((True, checkpoint))
 
-            pattern, columns = self.get_fw_query_pattern(str_fw_ids)
-            self.cursor.execute(pattern)
+    def _track_commit(self, checkpoint: Dict) -> None:
+        with self._pending_lock:
+            self._pending.append((False, checkpoint))
+            self._flush_commits()
 
-            while data := self.cursor.fetchmany(self.bunch_size):
-                yield data, columns
+    def _flush_commits(self) -> None:
+        while self._pending and not self._pending[0][0]:
+            state.set_states(self._pending.popleft()[1])
+
+    def get_progress(self, entity: str) -> Optional[str]:
+        return state.get_state(self.PROGRESS_KEY.format(entity=entity)) or None
+
+    def get_bunch_checkpoint(self, entity: str, data: List) -> Dict:
+        last_id = str(data[-1][0])
+        return {
+            self.PROGRESS_KEY.format(entity=entity): last_id,
+            self.LAST_LOADED_FW_KEY: last_id,
+        }
+
+    def get_windows(self) -> Iterator[Tuple[str, str]]:
+        """
+        Split the extraction period into time windows.
+        An unfinished window of the previous run is always extracted first
+        with the same bounds, so its checkpoints stay valid.
+        """
+        since = datetime.fromisoformat(self.last_extracted_time)
+        till = datetime.fromisoformat(self.current_time)
+
+        window_end = state.get_state(self.WINDOW_END_KEY)
+        if window_end and since < datetime.fromisoformat(window_end) <= till:
+            yield since.isoformat(), window_end
+            since = datetime.fromisoformat(window_end)
+
+        step = timedelta(hours=self.window_hours)
+        while since < till:
+            end = min(since + step, till) if self.window_hours else till
+            yield since.isoformat(), end.isoformat()
+            since = end
+
+    def get_cleared_progress(self) -> Dict:
+        stages = [
+            *self.CHANGED_ENTITIES,
+            *[self.PARTIAL_STAGE.format(entity=entity)
+              for entity in self.CHANGED_ENTITIES],
+        ]
+        return {self.PROGRESS_KEY.format(entity=stage): '' for stage in stages}
+
+    def start_window(self, since: str, till: str) -> None:
+        self.since, self.till = since, till
+        if state.get_state(self.WINDOW_END_KEY) != till:
+            state.set_states({
+                self.WINDOW_END_KEY: till,
+                **self.get_cleared_progress(),
+            })
+        logger.info(f'Extraction of window {since} - {till} was started')
 
-    def get_fw_query_pattern(self, str_fw_ids: str):
+    def commit_window(self) -> None:
+        self._track_commit({
+            self.LAST_EXTRACTED_KEY: self.till,
+            **self.get_cleared_progress(),
+        })
+
+    def start_full_reload(self) -> Optional[str]:
+        """
+        Get the film work a full reload is resumed after.
+        A full reload is resumed only if no window was committed since it
+        was started, otherwise it starts anew. The start time is saved
+        next to the progress: film works loaded before a resume may have
+        changed since then, so the watermark is moved only up to it.
+        """
+        last_id = self.get_progress(self.FULL_RELOAD_ENTITY)
+        started = state.get_state(self.FULL_RELOAD_STARTED_KEY)
+        if last_id and started and (
+                datetime.fromisoformat(self.last_extracted_time)
+                < datetime.fromisoformat(started)
+        ):
+            self.full_reload_started = started
+            return last_id
+
+        self.full_reload_started = self.current_time
+        state.set_states({
+            self.FULL_RELOAD_STARTED_KEY: self.current_time,
+            self.PROGRESS_KEY.format(entity=self.FULL_RELOAD_ENTITY): '',
+        })
+        return None
+
+    def commit_full_reload(self) -> None:
+        self._track_commit({
+            self.LAST_EXTRACTED_KEY: self.full_reload_started,
+            self.FULL_RELOAD_STARTED_KEY: '',
+            self.PROGRESS_KEY.format(entity=self.FULL_RELOAD_ENTITY): '',
+        })
+
+    def commit_stage(self, entity: str) -> None:
+        self._track_commit(
+            {self.PROGRESS_KEY.format(entity=entity): self.STAGE_DONE}
+        )
+
+    def get_changed_fw_ids_query(self, entity: str) -> str:
+        after_condition = '''
+            AND (%(after)s::uuid IS NULL OR {fw_id} > %(after)s::uuid)
+            ORDER BY {fw_id};
+        '''
+        queries = {
+            'film_work': '''
+                SELECT fw.id
+                FROM content.film_work fw
+                WHERE fw.modified BETWEEN %(since)s AND %(till)s
+            ''' + after_condition.format(fw_id='fw.id'),
+            'person': '''
+                SELECT DISTINCT pfw.film_work_id
+                FROM content.person_film_work pfw
+                JOIN content.person p ON p.id = pfw.person_id
+                WHERE p.modified BETWEEN %(since)s AND %(till)s
+                    AND p.id <> ALL(%(renamed)s::uuid[])
+            ''' + after_condition.format(fw_id='pfw.film_work_id'),
+            'genre': '''
+                SELECT DISTINCT gfw.film_work_id
+                FROM content.genre_film_work gfw
+                JOIN content.genre g ON g.id = gfw.genre_id
+                WHERE g.modified BETWEEN %(since)s AND %(till)s
+                    AND g.id <> ALL(%(renamed)s::uuid[])
+            ''' + after_condition.format(fw_id='gfw.film_work_id'),
+        }
+        return queries[entity]
+
+    def get_fw_query_pattern(self, condition: str):
         pattern = f'''
             SELECT
                 fw.id,
@@ -93,8 +254,9 @@ class DataExtractor:
             LEFT JOIN content.person p ON p.id = pfw.person_id
             LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
             LEFT JOIN content.genre g ON g.id = gfw.genre_id
-            WHERE fw.id IN ('{str_fw_ids}')
-            GROUP BY fw.id;
+            WHERE {condition}
+            GROUP BY fw.id
+            ORDER BY fw.id;
         '''
         columns = [
             'id', 'title', 'description', 'imdb_rating', 'director',
@@ -102,13 +264,310 @@ class DataExtractor:
         ]
         return pattern, columns
 
-    @backoff(logger=logger)
+    def get_document_query_pattern(self, condition: str):
+        """
+        Read film works rendered in advance by the database.
+        content.film_work_document is refreshed by triggers for every
+        changed film work, so a page is read without joining link tables.
+        """
+        pattern = f'''
+            SELECT fw.id, doc.*
+            FROM content.film_work_document fw,
+                jsonb_to_record(fw.document) AS doc(
+                    title text,
+                    description text,
+                    imdb_rating float,
+                    director text[],
+                    actors_names text[],
+                    writers_names text[],
+                    actors json,
+                    writers json,
+                    genre text[]
+                )
+            WHERE {condition}
+            ORDER BY fw.id;
+        '''
+        columns = [
+            'id', 'title', 'description', 'imdb_rating', 'director',
+            'actors_names', 'writers_names', 'actors', 'writers', 'genre'
+        ]
+        return pattern, columns
+
+    def get_rendered_query_pattern(self, pattern: str, columns: List[str]):
+        """
+        Let Postgres render complete bulk entries of the film works.
+        The entries are sent to elasticsearch as they are, documents are
+        never decoded in Python.
+        """
+        rendered = f'''
+            SELECT
+                doc.id,
+                '{{"update":{{"_id":"' || doc.id || '"}}}}' || E'\\n'
+                    || '{{"doc":' || row_to_json(doc)::text
+                    || ',"doc_as_upsert":true}}' || E'\\n'
+            FROM ({pattern.strip().rstrip(';')}) AS doc({', '.join(columns)})
+            ORDER BY doc.id;
+        '''
+        return rendered, RENDERED_COLUMNS
+
+
+class DataExtractor(BaseExtractor):
+    """
+    Extract film works with psycopg2.
+    Queries which read through server-side cursors are retried together
+    with the cursors they are nested in: an error aborts the transaction
+    and its cursors, so the outermost generator is resumed after its last
+    yielded bunch on the recovered connection.
+    """
+
+    def __init__(self, connection, streaming: bool = False,
+                 full_reload: bool = False, window_hours: int = 0,
+                 partial_updater=None, assembler=None,
+                 documents: bool = False, rendered: bool = False):
+        super().__init__(streaming, full_reload, window_hours)
+        self.connection = connection
+        self._cursor = None
+        self.partial_updater = partial_updater
+        self.assembler = None if documents or rendered else assembler
+        self.documents = documents
+        self.rendered = rendered
+
+    def get_fw_query_pattern(self, condition: str):
+        if self.assembler is not None:
+            return self.assembler.get_fw_query_pattern(condition)
+        if self.documents:
+            pattern, columns = self.get_document_query_pattern(condition)
+        else:
+            pattern, columns = super().get_fw_query_pattern(condition)
+        if self.rendered:
+            return self.get_rendered_query_pattern(pattern, columns)
+        return pattern, columns
+
+    @property
+    def cursor(self):
+        """Client-side cursor, opened again with a reopened connection"""
+        if self._cursor is None or self._cursor.closed:
+            self._cursor = self.connection.cursor()
+        return self._cursor
+
+    def assemble(self, data: List) -> List:
+        """Join names to flat film work rows when the assembler is used"""
+        if self.assembler is not None:
+            with metrics.timer('app_join'):
+                return self.assembler.assemble(data)
+        return data
+
+    def extract(self):
+        if self.full_reload:
+            yield from self.extract_full()
+            self.commit_full_reload()
+            return
+
+        for since, till in self.get_windows():
+            self.start_window(since, till)
+            if self.assembler is not None:
+                self.assembler.refresh()
+            if self.streaming:
+                yield from self.extract_streaming()
+            else:
+                yield from self.extract_changed()
+            self.commit_window()
+
+    def extract_changed(self):
+        with metrics.timer('change_detection'):
+            fw_ids_persons_changed = self.get_fw_ids_persons_changed()
+            fw_ids_genres_changed = self.get_fw_ids_genres_changed()
+            film_work_changed = set()
+            for film_work_bunch in self.get_film_work_changed():
+                film_work_changed.update(film_work_bunch)
+
+        all_changed_fw_ids = (
+                fw_ids_persons_changed |
+                fw_ids_genres_changed |
+                film_work_changed
+        )
+        logger.info(f'{len(all_changed_fw_ids)} items were extracted')
+
+        if all_changed_fw_ids:
+            for data, columns in self.iter_film_works(
+                    list(all_changed_fw_ids)
+            ):
+                self._track_bunch({})
+                yield data, columns
+
+    def extract_streaming(self) -> Iterator[Tuple[List, List[str]]]:
+        """
+        Extract changed film works without materializing the set of their ids.
+        Changes of every entity are extracted as a separate stage ordered by
+        film work id, so a stage can be resumed after its last loaded bunch.
+        Ids are read by a server-side cursor in bunches, every bunch is passed
+        to the aggregation query as an array parameter and the aggregation
+        result is read by another server-side cursor.
+        """
+        for entity in self.CHANGED_ENTITIES:
+            renamed = []
+            if (self.partial_updater is not None
+                    and entity in self.partial_updater.ENTITIES):
+                renamed = self.update_partially(entity)
+
+            progress = self.get_progress(entity)
+            if progress == self.STAGE_DONE:
+                continue
+
+            extracted = 0
+            for data, columns in self.iter_stage(entity, progress, renamed):
+                extracted += len(data)
+                self._track_bunch(self.get_bunch_checkpoint(entity, data))
+                yield data, columns
+            logger.info(f'{extracted} items changed by {entity} '
+                        f'were extracted')
+
+            self.commit_stage(entity)
+
+    def update_partially(self, entity: str) -> List[str]:
+        """
+        Apply renames of the entity right away, before affected film works
+        are extracted. Progress is saved after every processed bunch.
+        Returns ids of the renamed entities, their film works are not
+        re-rendered by the regular stage of the entity.
+        """
+        stage = self.PARTIAL_STAGE.format(entity=entity)
+        progress = self.get_progress(stage)
+        if progress != self.STAGE_DONE:
+            updates = self.partial_updater.update(entity, self.since,
+                                                  self.till, progress)
+            for last_id in updates:
+                state.set_state(self.PROGRESS_KEY.format(entity=stage),
+                                last_id)
+            self.commit_stage(stage)
+        return self.partial_updater.registry.get_renamed(entity)
+
+    def extract_full(self) -> Iterator[Tuple[List, List[str]]]:
+        """
+        Extract all film works page by page without change detection.
+        Pages are taken by keyset pagination over film work ids and the
+        extraction is resumed after the last loaded page.
+        """
+        total = self.count_film_works()
+        last_id = self.start_full_reload()
+        logger.info(f'Full reload of {total} film works was started')
+        if last_id:
+            logger.info(f'Full reload is resumed after film work {last_id}')
+
+        extracted = 0
+        for data, columns in self.iter_pages(after=last_id):
+            extracted += len(data)
+            logger.info(f'{extracted}/{total} items were extracted')
+            self._track_bunch(
+                self.get_bunch_checkpoint(self.FULL_RELOAD_ENTITY, data)
+            )
+            yield data, columns
+
+    def extract_shard(self, lower_id: Optional[str],
+                      upper_id: Optional[str]) -> Iterator[Tuple[List, List]]:
+        """
+        Extract film works with ids in [lower_id, upper_id) range.
+        Shards are extracted without checkpoints, the caller is responsible
+        for the watermark of the whole reindex.
+        """
+        extracted = 0
+        for data, columns in self.iter_pages(lower_id, upper_id):
+            extracted += len(data)
+            yield data, columns
+        logger.info(f'{extracted} items of shard {lower_id} - {upper_id} '
+                    f'were extracted')
+
+    @backoff(logger=logger, policy='postgres',
+             resume=lambda bunch: {'after': bunch[0][-1][0]})
+    def iter_pages(self, lower_id: Optional[str] = None,
+                   upper_id: Optional[str] = None,
+                   after: Optional[str] = None) -> Iterator[Tuple[List, List]]:
+        pattern, columns = self.get_fw_query_pattern(self.FW_PAGE_CONDITION)
+        while data := self.fetch_page(pattern, after, lower_id, upper_id):
+            after = data[-1][0]
+            yield self.assemble(data), columns
+
+    @backoff(logger=logger, policy='postgres')
+    def count_film_works(self) -> int:
+        self.cursor.execute('SELECT count(*) FROM content.film_work;')
+        return self.cursor.fetchone()[0]
+
+    def fetch_page(self, pattern: str, last_id,
+                   lower_id=None, upper_id=None) -> List:
+        with metrics.timer('aggregation'):
+            self.cursor.execute(pattern, {
+                'last_id': last_id,
+                'lower_id': lower_id,
+                'upper_id': upper_id,
+                'limit': self.bunch_size,
+            })
+            data = self.cursor.fetchall()
+        metrics.increment('rows_extracted', len(data))
+        return data
+
+    def fetch_many(self, cursor, stage: str) -> List:
+        with metrics.timer(stage):
+            data = cursor.fetchmany(self.bunch_size)
+        metrics.increment('rows_extracted' if stage == 'aggregation'
+                          else 'changed_ids', len(data))
+        return data
+
+    @backoff(logger=logger, policy='postgres',
+             resume=lambda bunch: {'after': bunch[0][-1][0]})
+    def iter_stage(self, entity: str, after: Optional[str] = None,
+                   renamed: Optional[List[str]] = None
+                   ) -> Iterator[Tuple[List, List[str]]]:
+        """
+        Film works changed by the entity in order of their ids.
+        Film works of every bunch of ids are read while the cursor of
+        the ids is open, both are read anew after an error.
+        """
+        for fw_ids in self.iter_changed_fw_ids(entity, after, renamed):
+            yield from self.fetch_film_works(fw_ids)
+
+    @backoff(logger=logger, policy='postgres',
+             resume=lambda bunch: {'after': bunch[0][-1][0]})
+    def iter_film_works(self, fw_ids: List, after: Optional[str] = None
+                        ) -> Iterator[Tuple[List, List[str]]]:
+        yield from self.fetch_film_works(fw_ids, after)
+
+    def iter_changed_fw_ids(self, entity: str,
+                            after: Optional[str] = None,
+                            renamed: Optional[List[str]] = None
+                            ) -> Iterator[List]:
+        ids_cursor = self.connection.cursor(name=f'changed_fw_ids_{entity}')
+        ids_cursor.itersize = self.bunch_size
+        ids_cursor.execute(self.get_changed_fw_ids_query(entity), {
+            'since': self.since,
+            'till': self.till,
+            'after': after,
+            'renamed': renamed or [],
+        })
+        try:
+            while data := self.fetch_many(ids_cursor, 'change_detection'):
+                yield [fw[0] for fw in data]
+        finally:
+            ids_cursor.close()
+
+    def fetch_film_works(self, fw_ids: List, after: Optional[str] = None
+                         ) -> Iterator[Tuple[List, List[str]]]:
+        pattern, columns = self.get_fw_query_pattern(self.FW_IDS_CONDITION)
+        fw_cursor = self.connection.cursor(name='film_works')
+        fw_cursor.itersize = self.bunch_size
+        fw_cursor.execute(pattern, {'fw_ids': fw_ids, 'after': after})
+        try:
+            while data := self.fetch_many(fw_cursor, 'aggregation'):
+                yield self.assemble(data), columns
+        finally:
+            fw_cursor.close()
+
+    @backoff(logger=logger, policy='postgres')
     def get_fw_ids_persons_changed(self) -> set:
         persons_query = f'''
             SELECT id 
             FROM content.person
             WHERE modified 
-            BETWEEN '{self.last_extracted_time}' AND '{self.current_time}';
+            BETWEEN '{self.since}' AND '{self.till}';
         '''
 
         self.cursor.execute(persons_query)
@@ -126,13 +585,13 @@ class DataExtractor:
 
         return {str(fw[0]) for fw in self.cursor.fetchall()}
 
-    @backoff(logger=logger)
+    @backoff(logger=logger, policy='postgres')
     def get_fw_ids_genres_changed(self) -> set:
         genres_query = f'''
             SELECT id
             FROM content.genre
             WHERE modified 
-            BETWEEN '{self.last_extracted_time}' AND '{self.current_time}';
+            BETWEEN '{self.since}' AND '{self.till}';
         '''
 
         self.cursor.execute(genres_query)
@@ -152,13 +611,14 @@ class DataExtractor:
 
         return {str(fw[0]) for fw in self.cursor.fetchall()}
 
-    @backoff(logger=logger)
+    # Bunches are merged into a set, so the query may be restarted anew
+    @backoff(logger=logger, policy='postgres', resume=lambda fw_ids: {})
     def get_film_work_changed(self):
         fw_query = f'''
             SELECT id 
             FROM content.film_work
             WHERE modified 
-            BETWEEN '{self.last_extracted_time}' AND '{self.current_time}';
+            BETWEEN '{self.since}' AND '{self.till}';
         '''
         self.cursor.execute(fw_query)
 
@@ -1,11 +1,20 @@
+import copy
 import logging
 import sys
-from typing import List, Dict, Optional
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from typing import List, Dict, Optional, Tuple
 
 from elasticsearch import helpers, Elasticsearch
 
 sys.path.append('../')
-from utils.backoff import backoff
+from metrics import metrics
+from ndjson import (RENDERED_COLUMNS, chunk_by_bytes, encode_documents,
+                    encode_updates)
+from pipeline import transform
+from utils.backoff import RETRYABLE_ES_STATUSES, backoff, get_policy
 
 
 logger = logging.getLogger(__name__)
@@ -117,44 +126,369 @@ MOVIES_MAPPING = {
 }
 
 
+def merge_mapping(mapping: Dict, overrides: Dict) -> Dict:
+    merged = copy.deepcopy(mapping)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_mapping(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+# Searches use flat *_names fields, so nested names are only stored and
+# relevance of names does not depend on the field length
+COMPACT_MOVIES_MAPPING = merge_mapping(MOVIES_MAPPING, {
+    'properties': {
+        'director': {'norms': False},
+        'actors_names': {'norms': False},
+        'writers_names': {'norms': False},
+        'actors': {'properties': {'name': {'index': False}}},
+        'writers': {'properties': {'name': {'index': False}}},
+    }
+})
+
+MAPPING_PROFILES = {
+    'full': MOVIES_MAPPING,
+    'compact': COMPACT_MOVIES_MAPPING,
+}
+
+
+def get_retryable_actions(failed: List[Tuple]) -> List[Dict]:
+    """
+    Get rejected actions worth resending.
+    BulkIndexError is raised if any action was rejected for good.
+    """
+    retryable, errors = [], []
+    for action, result in failed:
+        status = next(iter(result.values())).get('status')
+        if status in RETRYABLE_ES_STATUSES:
+            retryable.append(action)
+        else:
+            errors.append(result)
+    if errors:
+        raise helpers.BulkIndexError(
+            f'{len(errors)} document(s) failed to index', errors
+        )
+    return retryable
+
+
+def count_sent(actions: List[Dict]) -> None:
+    """
+    Count the bulk call and its actions.
+    The body is serialized by the client, so bytes_sent is only counted
+    for bodies encoded by the loader, where their size is known.
+    """
+    metrics.increment('bulk_requests')
+    metrics.increment('actions_sent', len(actions))
+
+
 class ESLoader:
     default_index_name = 'movies'
     default_settings = MOVIES_SETTINGS
     default_mappings = MOVIES_MAPPING
+    mapping_profiles = MAPPING_PROFILES
+    ndjson = False
+    chunk_bytes = 5 * 1024 * 1024
 
-    def __init__(self):
+    def __init__(self, bulk_threads: int = 1, refresh=False,
+                 document_hashes=None, ndjson: Optional[bool] = None):
         from config.settings import settings
 
-        self.es = Elasticsearch(settings.ES_DSN)
+        self.es = Elasticsearch(settings.ES_DSN,
+                                http_compress=settings.ES_HTTP_COMPRESS)
+        self.bulk_threads = bulk_threads
+        self.refresh = refresh
+        self.existing_indices = set()
+        self.document_hashes = document_hashes
+        self.ndjson = settings.ETL_NDJSON if ndjson is None else ndjson
+        self.chunk_bytes = settings.ES_BULK_CHUNK_BYTES
+        self.written = 0
+        self.skipped = 0
 
-    @backoff(logger=logger)
     def load(self, data: List[Dict], index_name: str = default_index_name):
-        data = self.prepare_for_update(data)
+        actions, hashes = self.prepare(data)
+        self.send(actions, index_name, hashes)
+
+    def load_rows(self, data: List, columns: List[str],
+                  index_name: str = default_index_name):
+        actions, hashes = self.prepare_rows(data, columns)
+        self.send(actions, index_name, hashes)
+
+    def prepare_rows(self, data: List,
+                     columns: List[str]) -> Tuple[List, Dict]:
+        """
+        Prepare cursor rows for the bulk request.
+        With ndjson the rows are encoded straight into bulk entries,
+        skipping intermediate dicts and serialization by the client.
+        Entries rendered by Postgres are passed through as they are.
+        """
+        if columns == RENDERED_COLUMNS:
+            with metrics.timer('transform'):
+                entries = [(str(_id), entry.encode()) for _id, entry in data]
+            entries, hashes = self.filter_encoded(entries)
+            return [entry for _, entry in entries], hashes
+
+        if not self.ndjson:
+            return self.prepare(transform(data, columns))
+
+        with metrics.timer('transform'):
+            documents = encode_documents(data, columns)
+        documents, hashes = self.filter_encoded(documents)
+        return encode_updates(documents), hashes
+
+    def filter_encoded(self, documents: List[Tuple[str, bytes]]) -> Tuple[
+        List[Tuple[str, bytes]], Dict
+    ]:
+        """Skip encoded documents sent before without changes"""
+        with metrics.timer('prepare'):
+            if self.document_hashes is None:
+                return documents, {}
+            changed, hashes = self.document_hashes.filter_changed_encoded(
+                documents
+            )
+            self.skipped += len(documents) - len(changed)
+            metrics.increment('documents_skipped',
+                              len(documents) - len(changed))
+            return changed, hashes
+
+    def prepare(self, data: List[Dict]) -> Tuple[List[Dict], Dict]:
+        """
+        Prepare documents for the bulk request.
+        Documents sent before without changes are skipped.
+        """
+        with metrics.timer('prepare'):
+            hashes = {}
+            if self.document_hashes is not None:
+                changed, hashes = self.document_hashes.filter_changed(data)
+                self.skipped += len(data) - len(changed)
+                metrics.increment('documents_skipped',
+                                  len(data) - len(changed))
+                data = changed
+            return self.prepare_for_update(data), hashes
+
+    def send(self, actions: List[Dict], index_name: str = default_index_name,
+             hashes: Optional[Dict] = None):
+        if actions:
+            self.bulk(actions, index_name)
+            self.written += len(actions)
+            metrics.increment('documents_written', len(actions))
+        if self.document_hashes is not None and hashes:
+            self.document_hashes.save(hashes)
+
+    def bulk(self, actions: List, index_name: str = default_index_name):
+        """
+        Send actions and resend only the ones rejected with a retryable
+        status, other rejected actions are raised as BulkIndexError.
+        Actions are either dicts or encoded bulk entries.
+        """
+        send = self.send_bulk
+        if actions and isinstance(actions[0], bytes):
+            send = self.send_encoded
+        policy = get_policy('elasticsearch')
+        attempt = 0
+        while actions:
+            failed = send(actions, index_name)
+            actions = get_retryable_actions(failed)
+            if not actions:
+                break
+            sleep_time = policy.get_sleep_time(attempt)
+            if sleep_time is None:
+                raise helpers.BulkIndexError(
+                    f'{len(actions)} document(s) were rejected', failed
+                )
+            logger.info(f'{len(actions)} rejected documents will be resent')
+            metrics.increment('documents_resent', len(actions))
+            time.sleep(sleep_time)
+            attempt += 1
+
+    @backoff(logger=logger, policy='elasticsearch')
+    def send_bulk(self, actions: List[Dict],
+                  index_name: str = default_index_name) -> List[Tuple]:
+        """Send actions, returns the rejected actions with their results"""
+        self.ensure_index(index_name)
+        count_sent(actions)
+        with metrics.timer('bulk'):
+            if self.bulk_threads > 1:
+                results = helpers.parallel_bulk(
+                    self.es, actions, index=index_name,
+                    thread_count=self.bulk_threads, raise_on_error=False
+                )
+            else:
+                results = helpers.streaming_bulk(
+                    self.es, actions, index=index_name,
+                    refresh=self.refresh, raise_on_error=False
+                )
+            return [(action, result)
+                    for action, (ok, result) in zip(actions, results)
+                    if not ok]
+
+    def send_encoded(self, entries: List[bytes],
+                     index_name: str = default_index_name) -> List[Tuple]:
+        """
+        Send encoded entries in chunks limited by size in bytes.
+        Returns the rejected entries with their results.
+        """
+        self.ensure_index(index_name)
+        chunks = list(chunk_by_bytes(entries, self.chunk_bytes))
+        bodies = [b''.join(chunk) for chunk in chunks]
+        if self.bulk_threads > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(self.bulk_threads) as pool:
+                responses = list(pool.map(
+                    lambda body: self.send_chunk(body, index_name), bodies
+                ))
+        else:
+            responses = [self.send_chunk(body, index_name)
+                         for body in bodies]
+
+        failed = []
+        for chunk, response in zip(chunks, responses):
+            if not response['errors']:
+                continue
+            failed.extend(
+                (entry, item) for entry, item in zip(chunk, response['items'])
+                if next(iter(item.values())).get('status', 500) >= 300
+            )
+        return failed
+
+    @backoff(logger=logger, policy='elasticsearch')
+    def send_chunk(self, body: bytes, index_name: str = default_index_name):
+        metrics.increment('bulk_requests')
+        metrics.increment('bytes_sent', len(body))
+        with metrics.timer('bulk'):
+            return self.es.bulk(operations=body, index=index_name,
+                                refresh=self.refresh)
+
+    @backoff(logger=logger, policy='elasticsearch')
+    def delete(self, ids: List, index_name: str = default_index_name):
+        self.ensure_index(index_name)
+        helpers.bulk(
+            self.es,
+            ({'_op_type': 'delete', '_id': str(_id)} for _id in ids),
+            index=index_name, refresh=self.refresh, ignore_status=(404,)
+        )
+        if self.document_hashes is not None:
+            self.document_hashes.forget(ids)
+
+    @backoff(logger=logger, policy='elasticsearch')
+    def update_fields(self, documents: Dict,
+                      index_name: str = default_index_name):
+        """Update some fields of indexed documents, missing ones are skipped"""
+        self.ensure_index(index_name)
+        helpers.bulk(
+            self.es,
+            ({'_op_type': 'update', '_id': str(_id), 'doc': doc}
+             for _id, doc in documents.items()),
+            index=index_name, refresh=self.refresh, ignore_status=(404,)
+        )
+        if self.document_hashes is not None:
+            self.document_hashes.forget(list(documents))
+
+    @backoff(logger=logger, policy='elasticsearch')
+    def update_by_query(self, query: Dict, script: Dict,
+                        index_name: str = default_index_name) -> Dict:
+        """
+        Conflicting documents are skipped, the caller checks
+        version_conflicts of the response and repeats the update.
+        """
+        self.ensure_index(index_name)
+        return self.es.update_by_query(
+            index=index_name, query=query, script=script,
+            conflicts='proceed', slices='auto', refresh=bool(self.refresh)
+        )
+
+    def ensure_index(self, index_name: str = default_index_name):
+        if index_name in self.existing_indices:
+            return
         if not self.es.indices.exists(index=index_name):
             logger.info(
                 f'Index "{index_name}" does not exist, '
                 f'index creation was started'
             )
-            self.create_index(index_name)
-        helpers.bulk(
-            self.es, data, index=index_name, refresh='wait_for'
-        )
+            versioned_name = self.create_versioned_index(index_name)
+            self.swap_alias(index_name, versioned_name)
+        self.existing_indices.add(index_name)
 
-    @backoff(logger=logger)
+    def create_versioned_index(self, alias: str = default_index_name,
+                               profile: str = 'full') -> str:
+        index_name = f'{alias}_{datetime.now():%Y%m%d%H%M%S}'
+        self.create_index(index_name,
+                          mappings=self.mapping_profiles[profile])
+        self.existing_indices.add(index_name)
+        return index_name
+
+    @backoff(logger=logger, policy='elasticsearch')
+    def swap_alias(self, alias: str, index_name: str):
+        """
+        Point the alias to the index in one atomic operation.
+        A concrete index with the alias name is removed in the same request.
+        """
+        actions = [{'add': {'index': index_name, 'alias': alias}}]
+        if self.es.indices.exists_alias(name=alias):
+            actions.insert(0, {'remove': {'index': '*', 'alias': alias}})
+        elif self.es.indices.exists(index=alias):
+            actions.insert(0, {'remove_index': {'index': alias}})
+        self.es.indices.update_aliases(actions=actions)
+        logger.info(f'Alias "{alias}" was moved to index "{index_name}"')
+
+    @backoff(logger=logger, policy='elasticsearch')
+    def get_alias_indices(self, alias: str = default_index_name) -> List[str]:
+        if not self.es.indices.exists_alias(name=alias):
+            return []
+        return list(self.es.indices.get_alias(name=alias))
+
+    @backoff(logger=logger, policy='elasticsearch')
+    def count(self, index_name: str = default_index_name) -> int:
+        return self.es.count(index=index_name)['count']
+
+    @contextmanager
+    def ingestion(self, index_name: str = default_index_name,
+                  force_merge: bool = False):
+        """
+        Prepare the index for a large load.
+        Refreshes and replicas are turned off during the load, afterwards
+        the previous settings are restored and the index is refreshed once.
+        """
+        self.ensure_index(index_name)
+        index_settings = next(iter(
+            self.es.indices.get_settings(index=index_name).values()
+        ))['settings']['index']
+        restored = {
+            'refresh_interval': index_settings.get(
+                'refresh_interval', self.default_settings['refresh_interval']
+            ),
+            'number_of_replicas': index_settings.get('number_of_replicas', 1),
+        }
+        self.es.indices.put_settings(index=index_name, settings={
+            'refresh_interval': '-1',
+            'number_of_replicas': 0,
+        })
+        logger.info(f'Index "{index_name}" was switched to ingestion mode')
+        try:
+            yield
+        finally:
+            self.es.indices.put_settings(index=index_name, settings=restored)
+            self.es.indices.refresh(index=index_name)
+            if force_merge:
+                self.es.indices.forcemerge(index=index_name,
+                                           max_num_segments=1)
+            logger.info(f'Index "{index_name}" settings were restored')
+
+    @backoff(logger=logger, policy='elasticsearch')
     def create_index(self, index_name: str = default_index_name,
                      settings: Optional[Dict] = None,
                      mappings: Optional[Dict] = None):
+        self.es.indices.create(index=index_name, ignore=400,
+                               body=self.get_index_body(settings, mappings))
+        logger.info(f'Index "{index_name}" was created')
+
+    def get_index_body(self, settings: Optional[Dict] = None,
+                       mappings: Optional[Dict] = None) -> Dict:
         if mappings is None:
             mappings = self.default_mappings
         if settings is None:
             settings = self.default_settings
-
-        self.es.indices.create(index=index_name, ignore=400,
-                               body={
-                                   'mappings': mappings,
-                                   'settings': settings
-                               })
-        logger.info(f'Index "{index_name}" was created')
+        return {'mappings': mappings, 'settings': settings}
 
     def prepare_for_update(self, data: List[Dict]) -> List[Dict]:
         prepared_data = [
@@ -167,6 +501,6 @@ class ESLoader:
         ]
         return prepared_data
 
-    @backoff(logger=logger)
+    @backoff(logger=logger, policy='elasticsearch')
     def search(self, search: Dict, index: str = default_index_name, **kwargs):
         return self.es.search(index=index, body=search, **kwargs)
@@ -1,40 +1,197 @@
-from contextlib import closing
+import asyncio
+from contextlib import closing, nullcontext
 from datetime import datetime
+from functools import wraps
+from typing import Dict, Optional, Tuple
 
-import psycopg2
+import psycopg2.extras
 from celery.utils.log import get_task_logger
-from psycopg2.extras import DictCursor
 
+from app_join import DocumentAssembler
 from celery_app import app as celery_app
 from data_loader import ESLoader
+from hashing import DocumentHashes
+from metrics import metrics
+from partial_update import NameRegistry, PartialUpdater
+from pipeline import Pipeline
+from postgres import PostgresConnection
 from storage import RedisStorage, State
 
 logger = get_task_logger(__name__)
 redis_cache = RedisStorage('redis')
 state = State(redis_cache)
 
+RUN_LOCK = 'run'
+RUN_SUMMARY_KEY = 'last_run_summary'
+
+
+def migrate_state() -> None:
+    """
+    Move the watermark kept in separate keys by previous versions into
+    the state hash, so the first run after the upgrade is incremental.
+    """
+    from data_extractor import DataExtractor
+
+    redis_cache.migrate_keys((DataExtractor.CURRENT_TIME_KEY,
+                              DataExtractor.LAST_EXTRACTED_KEY))
+
+
+def exclusive_run(task):
+    """
+    Skip the run while another run holds the lock, so overlapping runs
+    do not load the same windows and move the same checkpoints.
+    """
+    @wraps(task)
+    def inner(*args, **kwargs):
+        from config.settings import settings
+
+        with redis_cache.lease(RUN_LOCK,
+                               settings.ETL_LOCK_TIMEOUT) as acquired:
+            if not acquired:
+                logger.warning(f'{task.__name__} was skipped, '
+                               f'another run is in progress')
+                return None
+            migrate_state()
+            state.reset()
+            metrics.reset()
+            status = 'failure'
+            try:
+                result = task(*args, **kwargs)
+                status = 'success'
+                return result
+            finally:
+                report_run(task.__name__, status)
+    return inner
+
+
+def report_run(run: str, status: str) -> None:
+    """
+    Save the summary of the run next to the ETL state and export metrics
+    to the Prometheus textfile, if it is configured.
+    """
+    from config.settings import settings
+
+    try:
+        state.set_state(RUN_SUMMARY_KEY, metrics.dumps_summary(run, status))
+        if settings.ETL_METRICS_TEXTFILE:
+            metrics.write_textfile(settings.ETL_METRICS_TEXTFILE, run, status)
+    except Exception as e:
+        logger.error(f'Metrics of {run} were not reported: {e}')
+    else:
+        summary = metrics.summary()
+        logger.info(f'{run} finished with {status} in '
+                    f'{summary["duration_seconds"]}s, '
+                    f'{summary["documents_per_second"]} documents/s')
+
 
 @celery_app.task()
-def transfer_data():
+@exclusive_run
+def transfer_data(full_reload: bool = False):
     from data_extractor import DataExtractor
     from config.settings import settings
 
-    with closing(
-            psycopg2.connect(settings.DB_DSN, cursor_factory=DictCursor)
-    ) as pg_conn:
+    state.set_state(DataExtractor.CURRENT_TIME_KEY,
+                    datetime.now().isoformat())
+
+    document_hashes = None
+    if settings.ETL_SKIP_UNCHANGED:
+        document_hashes = DocumentHashes(redis_cache.redis_cache)
+
+    if settings.ETL_ENGINE == 'async':
+        from async_etl import transfer_data as async_transfer_data
+
+        loader = asyncio.run(
+            async_transfer_data(full_reload, document_hashes)
+        )
+    else:
+        loader = sync_transfer_data(full_reload, document_hashes)
+
+    logger.info(f'{loader.written} documents were written, '
+                f'{loader.skipped} unchanged documents were skipped')
+    logger.info(f'All data was successfully transferred to elasticsearch')
+
+
+def sync_transfer_data(full_reload: bool = False,
+                       document_hashes: Optional[DocumentHashes] = None,
+                       loader: Optional[ESLoader] = None,
+                       dsn: Optional[str] = None):
+    from data_extractor import DataExtractor
+    from config.settings import settings
+
+    dsn = dsn or settings.DB_DSN
+    with closing(PostgresConnection(dsn)) as pg_conn:
         psycopg2.extras.register_uuid()
 
-        state.set_state(DataExtractor.CURRENT_TIME_KEY,
-                        datetime.now().isoformat())
+        if loader is None:
+            loader = ESLoader(document_hashes=document_hashes)
+        partial_updater = None
+        if settings.ETL_STREAMING and settings.ETL_PARTIAL_UPDATES:
+            partial_updater = PartialUpdater(
+                pg_conn, loader,
+                NameRegistry(state.storage.redis_cache,
+                             state.storage.namespace)
+            )
 
-        extractor = DataExtractor(pg_conn)
-        loader = ESLoader()
+        assembler = None
+        if settings.ETL_APP_JOIN:
+            assembler = DocumentAssembler(pg_conn,
+                                          settings.ETL_NAME_CACHE_SIZE)
 
-        for data, columns in extractor.extract():
-            data_for_es = [dict(zip(columns, item)) for item in data]
-            loader.load(data_for_es)
+        extractor = DataExtractor(pg_conn,
+                                  streaming=settings.ETL_STREAMING,
+                                  full_reload=full_reload,
+                                  window_hours=settings.ETL_WINDOW_HOURS,
+                                  partial_updater=partial_updater,
+                                  assembler=assembler,
+                                  documents=settings.ETL_DOCUMENT_TABLE,
+                                  rendered=settings.ETL_RENDERED_BULK)
+        ingestion = nullcontext()
+        if extractor.full_reload:
+            loader.document_hashes = None
+            loader.bulk_threads = settings.ES_BULK_THREADS
+            ingestion = loader.ingestion(force_merge=settings.ETL_FORCE_MERGE)
 
-    state.set_state(DataExtractor.LAST_EXTRACTED_KEY,
-                    state.get_state(DataExtractor.CURRENT_TIME_KEY))
+        with ingestion:
+            if settings.ETL_PIPELINE:
+                Pipeline(extractor, loader, settings.ETL_QUEUE_SIZE).run()
+            else:
+                for data, columns in extractor.extract():
+                    loader.load_rows(data, columns)
+                    extractor.acknowledge()
 
-    logger.info(f'All data was successfully transferred to elasticsearch')
+        if extractor.full_reload and document_hashes is not None:
+            document_hashes.clear()
+    return loader
+
+
+@celery_app.task()
+def transfer_shard(snapshot_id: str, lower_id: str, upper_id: str,
+                   index_name: str) -> Tuple[int, Dict]:
+    from reindex import reindex_shard
+
+    return reindex_shard(snapshot_id, lower_id, upper_id, index_name)
+
+
+@celery_app.task()
+@exclusive_run
+def parallel_reindex(shards_count: int = 0):
+    from reindex import parallel_reindex, run_in_celery
+    from config.settings import settings
+
+    parallel_reindex(shards_count or settings.ETL_REINDEX_SHARDS,
+                     run_shards=run_in_celery)
+    logger.info(f'All data was successfully reindexed in elasticsearch')
+
+
+@celery_app.task()
+@exclusive_run
+def blue_green_reindex(shards_count: int = 0, profile: str = 'full'):
+    from reindex import blue_green_reindex, run_in_celery
+    from config.settings import settings
+
+    index_name = blue_green_reindex(
+        shards_count or settings.ETL_REINDEX_SHARDS,
+        run_shards=run_in_celery,
+        profile=profile
+    )
+    logger.info(f'All data was successfully reindexed into "{index_name}"')
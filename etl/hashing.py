@@ -0,0 +1,82 @@
+import hashlib
+import json
+import logging
+from typing import Dict, List, Tuple
+
+from utils.backoff import backoff
+
+logger = logging.getLogger(__name__)
+
+
+class DocumentHashes:
+    """
+    Short hashes of the documents last sent to elasticsearch, kept in one
+    redis hash by film work id. Used to skip documents which did not change.
+    """
+    KEY = 'etl:document_hashes'
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+
+    @staticmethod
+    def get_hash(document: Dict) -> str:
+        serialized = json.dumps(document, sort_keys=True, default=str)
+        return hashlib.blake2b(serialized.encode(), digest_size=8).hexdigest()
+
+    @staticmethod
+    def get_bytes_hash(content: bytes) -> str:
+        return hashlib.blake2b(content, digest_size=8).hexdigest()
+
+    def filter_changed(self,
+                       documents: List[Dict]) -> Tuple[List[Dict], Dict]:
+        """Return changed documents and their new hashes"""
+        return self.filter_hashed(
+            documents,
+            [str(document['id']) for document in documents],
+            [self.get_hash(document) for document in documents]
+        )
+
+    def filter_changed_encoded(
+            self, documents: List[Tuple[str, bytes]]
+    ) -> Tuple[List[Tuple[str, bytes]], Dict]:
+        """Return changed encoded documents and their new hashes"""
+        return self.filter_hashed(
+            documents,
+            [_id for _id, _ in documents],
+            [self.get_bytes_hash(content) for _, content in documents]
+        )
+
+    def filter_hashed(self, documents: List, ids: List[str],
+                      document_hashes: List[str]) -> Tuple[List, Dict]:
+        if not documents:
+            return [], {}
+        stored = self.get_stored(ids)
+
+        changed, hashes = [], {}
+        for document, _id, document_hash, stored_hash in zip(
+                documents, ids, document_hashes, stored
+        ):
+            if document_hash != stored_hash:
+                changed.append(document)
+                hashes[_id] = document_hash
+        return changed, hashes
+
+    @backoff(logger=logger, policy='redis')
+    def get_stored(self, ids: List[str]) -> List:
+        return self.redis.hmget(self.KEY, ids)
+
+    @backoff(logger=logger, policy='redis')
+    def save(self, hashes: Dict) -> None:
+        if hashes:
+            self.redis.hset(self.KEY, mapping=hashes)
+
+    @backoff(logger=logger, policy='redis')
+    def forget(self, ids: List) -> None:
+        if ids:
+            self.redis.hdel(self.KEY, *[str(_id) for _id in ids])
+
+    @backoff(logger=logger, policy='redis')
+    def clear(self) -> None:
+        # The hash holds a field per film work, UNLINK frees it in
+        # the background instead of blocking Redis
+        self.redis.unlink(self.KEY)
@@ -0,0 +1,190 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+from utils.backoff import add_retry_listener
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Metrics:
+    """
+    Timers and counters of the current ETL run.
+    Stages are timed by the timer context manager, counters are incremented
+    with optional labels. After the run the values are written as
+    a Prometheus textfile and summarized into the ETL state.
+    """
+    PREFIX = 'etl'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.started = time.monotonic()
+            self.timers: Dict[str, list] = defaultdict(lambda: [0, 0.0])
+            self.counters: Dict[Tuple[str, Labels], float] = defaultdict(
+                float
+            )
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.timers[stage][0] += 1
+                self.timers[stage][1] += elapsed
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def export(self, since: Optional[Dict] = None) -> Dict:
+        """
+        Metrics recorded after the since export in a JSON serializable
+        form, so a worker process can hand them over to its parent.
+        """
+        since = since or {}
+        timers_since = {stage: (calls, seconds)
+                        for stage, calls, seconds in since.get('timers', [])}
+        counters_since = {
+            (name, tuple(map(tuple, labels))): value
+            for name, labels, value in since.get('counters', [])
+        }
+        with self.lock:
+            timers = [
+                [stage, calls - timers_since.get(stage, (0, 0))[0],
+                 seconds - timers_since.get(stage, (0, 0))[1]]
+                for stage, (calls, seconds) in self.timers.items()
+                if calls != timers_since.get(stage, (0, 0))[0]
+            ]
+            counters = [
+                [name, [list(label) for label in labels],
+                 value - counters_since.get((name, labels), 0)]
+                for (name, labels), value in self.counters.items()
+                if value != counters_since.get((name, labels), 0)
+            ]
+        return {'pid': os.getpid(), 'timers': timers, 'counters': counters}
+
+    def merge(self, exported: Dict) -> None:
+        """
+        Add metrics exported by a worker process.
+        Metrics of a worker sharing the process are already recorded here.
+        """
+        if exported['pid'] == os.getpid():
+            return
+        with self.lock:
+            for stage, calls, seconds in exported['timers']:
+                self.timers[stage][0] += calls
+                self.timers[stage][1] += seconds
+            for name, labels, value in exported['counters']:
+                self.counters[(name, tuple(map(tuple, labels)))] += value
+
+    def get_counter(self, name: str) -> float:
+        return sum(value for (counter, _), value in self.counters.items()
+                   if counter == name)
+
+    def summary(self) -> Dict:
+        with self.lock:
+            duration = time.monotonic() - self.started
+            stages = {
+                stage: {'calls': calls, 'seconds': round(seconds, 6)}
+                for stage, (calls, seconds) in self.timers.items()
+            }
+            counters = defaultdict(dict)
+            for (name, labels), value in self.counters.items():
+                key = ','.join(f'{k}={v}' for k, v in labels) or 'total'
+                counters[name][key] = value
+
+        written = self.get_counter('documents_written')
+        bulk_seconds = stages.get('bulk', {}).get('seconds')
+        return {
+            'duration_seconds': round(duration, 6),
+            'documents_per_second': round(written / duration, 2)
+            if duration else 0,
+            'bulk_documents_per_second': round(written / bulk_seconds, 2)
+            if bulk_seconds else 0,
+            'stages': stages,
+            'counters': dict(counters),
+        }
+
+    def render(self, run: str, status: str) -> str:
+        """Render the metrics of the run in Prometheus text format"""
+        summary = self.summary()
+        run_labels = f'run="{run}"'
+        lines = [
+            f'# HELP {self.PREFIX}_stage_seconds Time spent in the stage '
+            f'during the last run',
+            f'# TYPE {self.PREFIX}_stage_seconds gauge',
+        ]
+        for stage, values in summary['stages'].items():
+            lines.append(f'{self.PREFIX}_stage_seconds'
+                         f'{{{run_labels},stage="{stage}"}} '
+                         f'{values["seconds"]}')
+        lines += [
+            f'# HELP {self.PREFIX}_stage_calls Number of times the stage '
+            f'ran during the last run',
+            f'# TYPE {self.PREFIX}_stage_calls gauge',
+        ]
+        for stage, values in summary['stages'].items():
+            lines.append(f'{self.PREFIX}_stage_calls'
+                         f'{{{run_labels},stage="{stage}"}} '
+                         f'{values["calls"]}')
+
+        with self.lock:
+            counters = list(self.counters.items())
+        for name in sorted({name for (name, _), _ in counters}):
+            lines.append(f'# TYPE {self.PREFIX}_{name} gauge')
+            for (counter, labels), value in counters:
+                if counter != name:
+                    continue
+                label_text = ''.join(f',{k}="{v}"' for k, v in labels)
+                lines.append(f'{self.PREFIX}_{name}'
+                             f'{{{run_labels}{label_text}}} {value}')
+
+        lines += [
+            f'# TYPE {self.PREFIX}_run_duration_seconds gauge',
+            f'{self.PREFIX}_run_duration_seconds{{{run_labels}}} '
+            f'{summary["duration_seconds"]}',
+            f'# TYPE {self.PREFIX}_run_documents_per_second gauge',
+            f'{self.PREFIX}_run_documents_per_second{{{run_labels}}} '
+            f'{summary["documents_per_second"]}',
+            f'# TYPE {self.PREFIX}_run_success gauge',
+            f'{self.PREFIX}_run_success{{{run_labels}}} '
+            f'{int(status == "success")}',
+            f'# TYPE {self.PREFIX}_run_finished_timestamp_seconds gauge',
+            f'{self.PREFIX}_run_finished_timestamp_seconds{{{run_labels}}} '
+            f'{time.time():.0f}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path: str, run: str, status: str) -> None:
+        """Replace the textfile atomically, so it is never read half written"""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as textfile:
+                textfile.write(self.render(run, status))
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def dumps_summary(self, run: str, status: str) -> str:
+        return json.dumps({'run': run, 'status': status, **self.summary()})
+
+
+metrics = Metrics()
+add_retry_listener(
+    lambda policy, func: metrics.increment('retries', policy=policy)
+)
@@ -0,0 +1,49 @@
+import json
+from typing import Iterator, List, Sequence, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+RENDERED_COLUMNS = ['id', 'bulk_entry']
+
+
+def dumps(value) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, default=str, ensure_ascii=False,
+                      separators=(',', ':')).encode()
+
+
+def encode_documents(data: List[Sequence],
+                     columns: List[str]) -> List[Tuple[str, bytes]]:
+    """Encode cursor rows into JSON documents keyed by the first column"""
+    return [(str(row[0]), dumps(dict(zip(columns, row)))) for row in data]
+
+
+def encode_updates(documents: List[Tuple[str, bytes]]) -> List[bytes]:
+    """
+    Build bulk entries upserting the encoded documents.
+    Every entry holds the action line and the source line, ids are uuids,
+    so they are put into the action line without escaping.
+    """
+    return [
+        b'{"update":{"_id":"%s"}}\n{"doc":%s,"doc_as_upsert":true}\n'
+        % (_id.encode(), document)
+        for _id, document in documents
+    ]
+
+
+def chunk_by_bytes(entries: List[bytes],
+                   max_bytes: int) -> Iterator[List[bytes]]:
+    """Split bulk entries into chunks of at most max_bytes each"""
+    chunk, size = [], 0
+    for entry in entries:
+        if chunk and size + len(entry) > max_bytes:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(entry)
+        size += len(entry)
+    if chunk:
+        yield chunk
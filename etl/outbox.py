@@ -0,0 +1,106 @@
+import logging
+import select
+from typing import List
+
+from postgres import PostgresConnection
+from utils.backoff import backoff
+
+logger = logging.getLogger(__name__)
+
+
+class Listener:
+    """
+    Notifications of a channel.
+    The channel is listened to again whenever the connection is reopened,
+    notifications sent meanwhile are made up by draining on timeout.
+    """
+
+    def __init__(self, dsn: str, channel: str):
+        self.channel = channel
+        self.connection = PostgresConnection(dsn, begin=self.listen,
+                                             autocommit=True)
+
+    def listen(self, connection) -> None:
+        with connection.cursor() as cursor:
+            cursor.execute(f'LISTEN {self.channel};')
+        logger.info(f'Listening to "{self.channel}" notifications')
+
+    @backoff(logger=logger, policy='postgres')
+    def wait(self, timeout: int) -> None:
+        """Wait for a notification or the timeout"""
+        readable, _, _ = select.select([self.connection], [], [], timeout)
+        if readable:
+            self.connection.poll()
+            self.connection.notifies.clear()
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class OutboxConsumer:
+    """
+    Synchronize film works changed in the admin panel in near real time.
+    Triggers put ids of affected film works into content.film_work_outbox
+    and notify the channel, the consumer drains the outbox in bunches.
+    Outbox rows are deleted in the same transaction the bunch is loaded in,
+    so a failed load leaves them for the next attempt.
+    """
+    CHANNEL = 'film_work_outbox'
+    DRAIN_QUERY = '''
+        DELETE FROM content.film_work_outbox
+        WHERE id IN (
+            SELECT id
+            FROM content.film_work_outbox
+            ORDER BY id
+            LIMIT %(limit)s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING film_work_id;
+    '''
+
+    def __init__(self, listener: Listener, connection: PostgresConnection,
+                 loader, bunch_size: int = 500, poll_timeout: int = 30,
+                 documents: bool = False, rendered: bool = False):
+        from data_extractor import DataExtractor
+
+        self.listener = listener
+        self.connection = connection
+        self.extractor = DataExtractor(connection, documents=documents,
+                                       rendered=rendered)
+        self.loader = loader
+        self.bunch_size = bunch_size
+        self.poll_timeout = poll_timeout
+
+    def run(self) -> None:
+        """Drain the outbox on every notification, on timeout anyway"""
+        while True:
+            self.drain()
+            self.listener.wait(self.poll_timeout)
+
+    def drain(self) -> int:
+        drained = 0
+        while fw_ids := self.drain_bunch():
+            drained += len(fw_ids)
+        if drained:
+            logger.info(f'{drained} items were synchronized from outbox')
+        return drained
+
+    @backoff(logger=logger, policy='postgres')
+    def drain_bunch(self) -> List:
+        with self.connection:
+            with self.connection.cursor() as cursor:
+                cursor.execute(self.DRAIN_QUERY, {'limit': self.bunch_size})
+                fw_ids = list({row[0] for row in cursor.fetchall()})
+            if fw_ids:
+                self.synchronize(fw_ids)
+        return fw_ids
+
+    def synchronize(self, fw_ids: List) -> None:
+        found = set()
+        for data, columns in self.extractor.fetch_film_works(fw_ids):
+            self.loader.load_rows(data, columns)
+            found.update(item[0] for item in data)
+
+        deleted = [fw_id for fw_id in fw_ids if fw_id not in found]
+        if deleted:
+            self.loader.delete(deleted)
@@ -0,0 +1,272 @@
+import logging
+from typing import Dict, Iterator, List, Optional
+
+from metrics import metrics
+from utils.backoff import backoff
+
+logger = logging.getLogger(__name__)
+
+
+class NameRegistry:
+    """
+    Names of persons and genres as the ETL last saw them, and ids renamed
+    by partial updates in the current window.
+    Only an entity with a known previous name can be renamed in place,
+    others may be new or relinked and their film works are re-rendered.
+    Names of all entities are saved on the first use, see
+    PartialUpdater.seed.
+    """
+    NAMES_KEY = '{namespace}:names:{entity}'
+    RENAMED_KEY = '{namespace}:renamed:{entity}'
+
+    def __init__(self, redis_client, namespace: str = 'etl:state'):
+        self.redis = redis_client
+        self.namespace = namespace
+
+    def get_key(self, key: str, entity: str) -> str:
+        return key.format(namespace=self.namespace, entity=entity)
+
+    @backoff(logger=logger, policy='redis')
+    def has_names(self, entity: str) -> bool:
+        return bool(self.redis.exists(self.get_key(self.NAMES_KEY, entity)))
+
+    @backoff(logger=logger, policy='redis')
+    def get_names(self, entity: str, ids: List[str]) -> Dict[str, str]:
+        names = self.redis.hmget(self.get_key(self.NAMES_KEY, entity), ids)
+        return {_id: name for _id, name in zip(ids, names)
+                if name is not None}
+
+    @backoff(logger=logger, policy='redis')
+    def save_names(self, entity: str, names: Dict[str, str]) -> None:
+        if names:
+            self.redis.hset(self.get_key(self.NAMES_KEY, entity),
+                            mapping=names)
+
+    @backoff(logger=logger, policy='redis')
+    def add_renamed(self, entity: str, ids: List[str]) -> None:
+        if ids:
+            self.redis.sadd(self.get_key(self.RENAMED_KEY, entity), *ids)
+
+    @backoff(logger=logger, policy='redis')
+    def get_renamed(self, entity: str) -> List[str]:
+        return sorted(self.redis.smembers(
+            self.get_key(self.RENAMED_KEY, entity)
+        ))
+
+    @backoff(logger=logger, policy='redis')
+    def clear_renamed(self, entity: str) -> None:
+        self.redis.unlink(self.get_key(self.RENAMED_KEY, entity))
+
+
+class PartialUpdater:
+    """
+    Apply person and genre renames to indexed documents without rendering
+    the whole film works.
+    Nested actors and writers are renamed by one update by query per bunch
+    of persons. Directors and genres are stored by name only, so they are
+    recalculated from link tables for affected film works and sent as
+    partial documents.
+    Changes other than renames of known entities are left to the regular
+    re-rendering of film works, as are renames which were not applied.
+    """
+    ENTITIES = ('person', 'genre')
+    RENAME_ATTEMPTS = 3
+    SEED_BUNCH_SIZE = 5000
+
+    NAMES_QUERIES = {
+        'person': 'SELECT id, full_name FROM content.person;',
+        'genre': 'SELECT id, name FROM content.genre;',
+    }
+    CHANGED_QUERIES = {
+        'person': '''
+            SELECT id, full_name
+            FROM content.person
+            WHERE modified BETWEEN %(since)s AND %(till)s
+                AND (%(after)s::uuid IS NULL OR id > %(after)s::uuid)
+            ORDER BY id;
+        ''',
+        'genre': '''
+            SELECT id, name
+            FROM content.genre
+            WHERE modified BETWEEN %(since)s AND %(till)s
+                AND (%(after)s::uuid IS NULL OR id > %(after)s::uuid)
+            ORDER BY id;
+        ''',
+    }
+    DIRECTORS_QUERY = '''
+        SELECT pfw.film_work_id, ARRAY_AGG(DISTINCT p.full_name)
+        FROM content.person_film_work pfw
+        JOIN content.person p ON p.id = pfw.person_id
+        WHERE pfw.role = 'director' AND pfw.film_work_id IN (
+            SELECT film_work_id
+            FROM content.person_film_work
+            WHERE role = 'director' AND person_id = ANY(%(ids)s::uuid[])
+        )
+        GROUP BY pfw.film_work_id;
+    '''
+    GENRES_QUERY = '''
+        SELECT gfw.film_work_id, ARRAY_AGG(DISTINCT g.name)
+        FROM content.genre_film_work gfw
+        JOIN content.genre g ON g.id = gfw.genre_id
+        WHERE gfw.film_work_id IN (
+            SELECT film_work_id
+            FROM content.genre_film_work
+            WHERE genre_id = ANY(%(ids)s::uuid[])
+        )
+        GROUP BY gfw.film_work_id;
+    '''
+    RENAMED_FW_IDS_QUERY = '''
+        SELECT DISTINCT film_work_id
+        FROM content.person_film_work
+        WHERE role IN ('actor', 'writer')
+            AND person_id = ANY(%(ids)s::uuid[]);
+    '''
+    RENAME_SCRIPT = '''
+        for (def field : params.fields) {
+            def persons = ctx._source[field];
+            if (persons == null) {
+                continue;
+            }
+            def names = new TreeSet();
+            for (def person : persons) {
+                if (params.names.containsKey(person.id)) {
+                    person.name = params.names[person.id];
+                }
+                names.add(person.name);
+            }
+            ctx._source[field + '_names'] = new ArrayList(names);
+        }
+    '''
+    NESTED_PERSONS = ('actors', 'writers')
+
+    def __init__(self, connection, loader, registry: NameRegistry,
+                 bunch_size: int = 500):
+        self.connection = connection
+        self.loader = loader
+        self.registry = registry
+        self.bunch_size = bunch_size
+
+    @backoff(logger=logger, policy='postgres',
+             resume=lambda last_id: {'after': last_id})
+    def update(self, entity: str, since: str, till: str,
+               after: Optional[str] = None) -> Iterator[str]:
+        """
+        Update documents affected by renamed entities in bunches.
+        Applied renames are added to the renamed ids of the registry.
+        Yields the id of the last entity of every processed bunch.
+        Queries of a bunch run while the cursor of changed entities is
+        open, so the update is resumed after the last processed bunch.
+        """
+        if after is None:
+            self.registry.clear_renamed(entity)
+        if not self.registry.has_names(entity):
+            self.seed(entity)
+
+        updated = 0
+        for names in self.iter_changed(entity, since, till, after):
+            previous = self.registry.get_names(entity, list(names))
+            renamed = {_id: name for _id, name in names.items()
+                       if previous.get(_id, name) != name}
+            if renamed and self.rename(entity, renamed):
+                self.registry.add_renamed(entity, list(renamed))
+                metrics.increment('partial_updates', len(renamed),
+                                  entity=entity)
+                updated += len(renamed)
+            self.registry.save_names(entity, names)
+            yield list(names)[-1]
+        logger.info(f'{updated} renamed items of {entity} were applied '
+                    f'by partial updates')
+
+    def seed(self, entity: str) -> None:
+        """
+        Save names of all entities of the kind, so renames are applied in
+        place from the first run. Entities changed in the current window
+        are saved with their new names, their film works are re-rendered.
+        """
+        cursor = self.connection.cursor(name=f'names_{entity}')
+        cursor.execute(self.NAMES_QUERIES[entity])
+        seeded = 0
+        try:
+            while data := cursor.fetchmany(self.SEED_BUNCH_SIZE):
+                self.registry.save_names(
+                    entity, {str(row[0]): row[1] for row in data}
+                )
+                seeded += len(data)
+        finally:
+            cursor.close()
+        logger.info(f'{seeded} names of {entity} were saved')
+
+    def rename(self, entity: str, names: Dict[str, str]) -> bool:
+        with metrics.timer('partial_update'):
+            if entity == 'person':
+                return self.rename_persons(names)
+            self.update_fields('genre', self.GENRES_QUERY, list(names))
+            return True
+
+    def iter_changed(self, entity: str, since: str, till: str,
+                     after: Optional[str]) -> Iterator[Dict[str, str]]:
+        cursor = self.connection.cursor(name=f'renamed_{entity}')
+        cursor.execute(self.CHANGED_QUERIES[entity], {
+            'since': since,
+            'till': till,
+            'after': after,
+        })
+        try:
+            while data := cursor.fetchmany(self.bunch_size):
+                yield {str(row[0]): row[1] for row in data}
+        finally:
+            cursor.close()
+
+    def rename_persons(self, names: Dict[str, str]) -> bool:
+        """
+        Rename nested persons, the update by query is repeated while
+        documents change concurrently. Returns False if some documents
+        were still not updated, their film works are re-rendered then.
+        """
+        ids = list(names)
+        for _ in range(self.RENAME_ATTEMPTS):
+            response = self.loader.update_by_query(
+                query={'bool': {'should': [
+                    {'nested': {
+                        'path': field,
+                        'query': {'terms': {f'{field}.id': ids}},
+                    }}
+                    for field in self.NESTED_PERSONS
+                ]}},
+                script={
+                    'source': self.RENAME_SCRIPT,
+                    'params': {'names': names,
+                               'fields': self.NESTED_PERSONS},
+                },
+            )
+            if not response['version_conflicts'] and not response['failures']:
+                break
+            logger.warning(f'Renaming of {len(ids)} persons met '
+                           f'{response["version_conflicts"]} version '
+                           f'conflicts and {len(response["failures"])} '
+                           f'failures')
+        else:
+            return False
+
+        if self.loader.document_hashes is not None:
+            self.loader.document_hashes.forget(
+                self.fetch_column(self.RENAMED_FW_IDS_QUERY, ids)
+            )
+        self.update_fields('director', self.DIRECTORS_QUERY, ids)
+        return True
+
+    def update_fields(self, field: str, query: str, ids: List[str]) -> None:
+        cursor = self.connection.cursor(name=f'partial_{field}')
+        cursor.execute(query, {'ids': ids})
+        try:
+            while data := cursor.fetchmany(self.bunch_size):
+                self.loader.update_fields(
+                    {row[0]: {field: row[1]} for row in data}
+                )
+        finally:
+            cursor.close()
+
+    def fetch_column(self, query: str, ids: List[str]) -> List:
+        with self.connection.cursor() as cursor:
+            cursor.execute(query, {'ids': ids})
+            return [row[0] for row in cursor.fetchall()]
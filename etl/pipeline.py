@@ -0,0 +1,104 @@
+import logging
+import threading
+from queue import Empty, Full, Queue
+from typing import Any, Callable, Dict, List, Optional
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+def transform(data: List, columns: List[str]) -> List[Dict]:
+    with metrics.timer('transform'):
+        return [dict(zip(columns, item)) for item in data]
+
+
+class Pipeline:
+    """
+    Run extraction, transformation and loading concurrently.
+    Every stage works in its own thread, stages are connected by bounded
+    queues, so a fast stage waits for a slow one instead of piling up data.
+    Bunches are loaded and acknowledged in the order they were extracted.
+    """
+    poll_timeout = 0.5
+
+    def __init__(self, extractor, loader, queue_size: int = 2):
+        self.extractor = extractor
+        self.loader = loader
+        self.extracted = Queue(maxsize=queue_size)
+        self.transformed = Queue(maxsize=queue_size)
+        self.loaded = 0
+
+        self._stopped = threading.Event()
+        self._error: Optional[BaseException] = None
+
+    def run(self) -> int:
+        stages = [
+            threading.Thread(target=self._run_stage, args=(stage,),
+                             name=f'etl-{stage.__name__.strip("_")}')
+            for stage in (self._fetch, self._transform, self._send)
+        ]
+        for stage in stages:
+            stage.start()
+        for stage in stages:
+            stage.join()
+
+        if self._error is not None:
+            raise self._error
+        return self.loaded
+
+    def _run_stage(self, stage: Callable[[], None]) -> None:
+        try:
+            stage()
+        except BaseException as e:
+            logger.error(f'ETL stage {stage.__name__} failed: {e}')
+            self._error = self._error or e
+            self._stopped.set()
+
+    def _fetch(self) -> None:
+        bunches = self.extractor.extract()
+        try:
+            for bunch in bunches:
+                if not self._put(self.extracted, bunch):
+                    return
+        finally:
+            bunches.close()
+        self._put(self.extracted, _DONE)
+
+    def _transform(self) -> None:
+        while (bunch := self._get(self.extracted)) is not _DONE:
+            if bunch is None:
+                return
+            data, columns = bunch
+            prepared = self.loader.prepare_rows(data, columns)
+            if not self._put(self.transformed, prepared):
+                return
+        self._put(self.transformed, _DONE)
+
+    def _send(self) -> None:
+        while (prepared := self._get(self.transformed)) is not _DONE:
+            if prepared is None:
+                return
+            actions, hashes = prepared
+            self.loader.send(actions, hashes=hashes)
+            self.extractor.acknowledge()
+            self.loaded += len(actions)
+
+    def _put(self, queue: Queue, item: Any) -> bool:
+        while not self._stopped.is_set():
+            try:
+                queue.put(item, timeout=self.poll_timeout)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _get(self, queue: Queue) -> Any:
+        while not self._stopped.is_set():
+            try:
+                return queue.get(timeout=self.poll_timeout)
+            except Empty:
+                continue
+        return None
@@ -0,0 +1,66 @@
+import logging
+from typing import Callable, Optional
+
+import psycopg2
+from psycopg2.extras import DictCursor
+
+logger = logging.getLogger(__name__)
+
+
+class PostgresConnection:
+    """
+    psycopg2 connection which is recovered before a failed call is retried,
+    see utils.backoff.recover_connection.
+    An aborted transaction is rolled back and a lost connection is opened
+    again. begin is called with every new transaction, e.g. to import the
+    snapshot of a reindex again, so a retried call reads the same data.
+    Other attributes are those of the current psycopg2 connection, objects
+    sharing the connection use the reopened one as well.
+    """
+
+    def __init__(self, dsn: str,
+                 begin: Optional[Callable[[psycopg2.extensions.connection],
+                                          None]] = None,
+                 **session):
+        self.dsn = dsn
+        self.begin = begin
+        self.session = session
+        self.raw = None
+        self.connect()
+
+    def connect(self) -> None:
+        connection = psycopg2.connect(self.dsn, cursor_factory=DictCursor)
+        try:
+            if self.session:
+                connection.set_session(**self.session)
+            if self.begin is not None:
+                self.begin(connection)
+        except psycopg2.Error:
+            connection.close()
+            raise
+        self.raw = connection
+
+    def recover(self) -> None:
+        try:
+            if self.raw.closed:
+                logger.warning('Connection to Postgres was lost, '
+                               'it is opened again')
+                self.connect()
+            else:
+                self.raw.rollback()
+                if self.begin is not None:
+                    self.begin(self.raw)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            # The next attempt fails on the closed connection and
+            # recovers it once more
+            self.raw.close()
+            logger.warning(f'Connection to Postgres was not recovered: {e}')
+
+    def __getattr__(self, name: str):
+        return getattr(self.raw, name)
+
+    def __enter__(self):
+        return self.raw.__enter__()
+
+    def __exit__(self, *exc_info):
+        return self.raw.__exit__(*exc_info)
@@ -0,0 +1,220 @@
+import logging
+import multiprocessing
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing, contextmanager
+from datetime import datetime
+from functools import partial
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import psycopg2.extras
+
+logger = logging.getLogger(__name__)
+
+Shard = Tuple[Optional[str], Optional[str]]
+
+
+def get_shards(count: int) -> List[Shard]:
+    """Split the uuid space into `count` ranges of equal size"""
+    bounds = [
+        str(uuid.UUID(int=(1 << 128) * number // count))
+        for number in range(1, count)
+    ]
+    return list(zip([None, *bounds], [*bounds, None]))
+
+
+class ReindexValidationError(Exception):
+    pass
+
+
+@contextmanager
+def exported_snapshot(dsn: str) -> Iterator[Tuple[str, int]]:
+    """
+    Export a snapshot of a repeatable read transaction and count film works
+    visible in it.
+    The transaction is kept open until the context is exited, so the
+    snapshot can be imported by other sessions meanwhile.
+    """
+    with closing(psycopg2.connect(dsn)) as pg_conn:
+        pg_conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        with pg_conn.cursor() as cursor:
+            cursor.execute('SELECT pg_export_snapshot();')
+            snapshot_id = cursor.fetchone()[0]
+            cursor.execute('SELECT count(*) FROM content.film_work;')
+            yield snapshot_id, cursor.fetchone()[0]
+
+
+def import_snapshot(snapshot_id: str, connection) -> None:
+    with connection.cursor() as cursor:
+        cursor.execute('SET TRANSACTION SNAPSHOT %s;', (snapshot_id,))
+
+
+def reindex_shard(snapshot_id: str, lower_id: Optional[str],
+                  upper_id: Optional[str],
+                  index_name: str) -> Tuple[int, Dict]:
+    """
+    Load a shard, returns the number of loaded items and the metrics
+    recorded meanwhile, since the shard may run in another process.
+    The snapshot is imported by every transaction of the shard, also after
+    the connection is recovered, while the exporting transaction is open.
+    """
+    from app_join import DocumentAssembler
+    from config.settings import settings
+    from data_extractor import DataExtractor
+    from data_loader import ESLoader
+    from metrics import metrics
+    from postgres import PostgresConnection
+
+    recorded_before = metrics.export()
+
+    psycopg2.extras.register_uuid()
+    with closing(PostgresConnection(
+            settings.DB_DSN, begin=partial(import_snapshot, snapshot_id),
+            isolation_level='REPEATABLE READ', readonly=True
+    )) as pg_conn:
+        assembler = None
+        if settings.ETL_APP_JOIN:
+            assembler = DocumentAssembler(pg_conn,
+                                          settings.ETL_NAME_CACHE_SIZE)
+        extractor = DataExtractor(pg_conn, assembler=assembler,
+                                  documents=settings.ETL_DOCUMENT_TABLE,
+                                  rendered=settings.ETL_RENDERED_BULK)
+        loader = ESLoader(bulk_threads=settings.ES_BULK_THREADS)
+
+        loaded = 0
+        for data, columns in extractor.extract_shard(lower_id, upper_id):
+            loader.load_rows(data, columns, index_name)
+            loaded += len(data)
+    return loaded, metrics.export(since=recorded_before)
+
+
+def merge_shards(results: List) -> int:
+    """Merge metrics of the shards and count the loaded items"""
+    from metrics import metrics
+
+    loaded = 0
+    for shard_loaded, shard_metrics in results:
+        metrics.merge(shard_metrics)
+        loaded += shard_loaded
+    return loaded
+
+
+def run_in_processes(snapshot_id: str, shards: List[Shard],
+                     index_name: str) -> int:
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(len(shards), mp_context=context) as executor:
+        futures = [
+            executor.submit(reindex_shard, snapshot_id, *shard, index_name)
+            for shard in shards
+        ]
+        return merge_shards([future.result() for future in futures])
+
+
+def run_in_celery(snapshot_id: str, shards: List[Shard],
+                  index_name: str) -> int:
+    """
+    Run shards as celery subtasks and wait for them.
+    The worker needs more free slots than shards, otherwise the waiting
+    task blocks the slots its subtasks need.
+    """
+    from celery import group
+    from celery.result import allow_join_result
+
+    from etl import transfer_shard
+
+    result = group(
+        transfer_shard.s(snapshot_id, *shard, index_name) for shard in shards
+    ).apply_async()
+    with allow_join_result():
+        return merge_shards(result.get())
+
+
+RunShards = Callable[[str, List[Shard], str], int]
+
+
+def reindex_snapshot(shards_count: int, run_shards: RunShards,
+                     index_name: str) -> Tuple[str, int, int]:
+    """
+    Load all film works into the index by uuid range shards in parallel.
+    Every shard reads the same exported snapshot, so the index is built from
+    a consistent state of the database.
+    Returns the snapshot time, the number of loaded and expected items.
+    """
+    from config.settings import settings
+    from data_loader import ESLoader
+
+    current_time = datetime.now().isoformat()
+    shards = get_shards(shards_count)
+    logger.info(f'Parallel reindex with {len(shards)} shards '
+                f'into "{index_name}" was started')
+
+    ingestion = ESLoader().ingestion(index_name, settings.ETL_FORCE_MERGE)
+    snapshot = exported_snapshot(settings.DB_DSN)
+    with ingestion, snapshot as (snapshot_id, expected):
+        loaded = run_shards(snapshot_id, shards, index_name)
+
+    logger.info(f'{loaded} of {expected} items were reindexed')
+    return current_time, loaded, expected
+
+
+def save_reindex_state(current_time: str) -> None:
+    """
+    Move the watermark to the snapshot time.
+    Hashes of sent documents are dropped, since they may describe documents
+    sent to another index after the snapshot.
+    """
+    from data_extractor import DataExtractor
+    from etl import redis_cache, state
+    from hashing import DocumentHashes
+
+    DocumentHashes(redis_cache.redis_cache).clear()
+
+    state.set_states({
+        DataExtractor.CURRENT_TIME_KEY: current_time,
+        DataExtractor.LAST_EXTRACTED_KEY: current_time,
+        DataExtractor.FULL_RELOAD_STARTED_KEY: '',
+        DataExtractor.PROGRESS_KEY.format(
+            entity=DataExtractor.FULL_RELOAD_ENTITY
+        ): '',
+    })
+
+
+def parallel_reindex(shards_count: int,
+                     run_shards: RunShards = run_in_processes) -> None:
+    """Reindex all film works into the current index in parallel"""
+    from data_loader import ESLoader
+
+    current_time, _, _ = reindex_snapshot(shards_count, run_shards,
+                                          ESLoader.default_index_name)
+    save_reindex_state(current_time)
+
+
+def blue_green_reindex(shards_count: int,
+                       run_shards: RunShards = run_in_processes,
+                       profile: str = 'full') -> str:
+    """
+    Build a new versioned index next to the live one and switch the alias
+    to it once the number of documents matches the database.
+    The live index keeps serving searches during the rebuild.
+    """
+    from data_loader import ESLoader
+
+    loader = ESLoader()
+    alias = ESLoader.default_index_name
+    previous = loader.get_alias_indices(alias)
+    index_name = loader.create_versioned_index(alias, profile)
+
+    current_time, _, expected = reindex_snapshot(shards_count, run_shards,
+                                                 index_name)
+    indexed = loader.count(index_name)
+    if indexed != expected:
+        raise ReindexValidationError(
+            f'Index "{index_name}" contains {indexed} documents '
+            f'instead of {expected}, alias "{alias}" was not switched'
+        )
+
+    loader.swap_alias(alias, index_name)
+    save_reindex_state(current_time)
+    logger.info(f'Previous indices {previous} can be removed '
+                f'after the new index is checked')
+    return index_name
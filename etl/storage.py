@@ -1,9 +1,23 @@
 import abc
+import copy
 import json
+import logging
 import os
-from typing import Any, Optional
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Any, Iterable, Iterator, Optional
 
 import redis
+from redis.exceptions import LockError
+
+from utils.backoff import backoff
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseLostError(Exception):
+    pass
 
 
 class BaseStorage:
@@ -17,42 +31,202 @@ class BaseStorage:
         """Загрузить состояние локально из постоянного хранилища"""
         pass
 
+    def retrieve_value(self, key: str) -> Any:
+        """Загрузить значение одного ключа из постоянного хранилища"""
+        return self.retrieve_state().get(key)
+
 
 class JsonFileStorage(BaseStorage):
-    def __init__(self, file_path: Optional[str] = None):
+    """
+    Изменения состояния дописываются строками в журнал рядом с файлом,
+    поэтому сохранение не перечитывает и не перезаписывает весь файл.
+    Каждые compact_every записей журнал сворачивается в снимок, который
+    пишется во временный файл и атомарно подменяет прежний.
+    Оборванная при аварии последняя строка журнала пропускается.
+    """
+
+    def __init__(self, file_path: Optional[str] = None,
+                 compact_every: int = 1000, fsync: bool = False):
         self.file_path = file_path
+        self.journal_path = f'{file_path}.journal'
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self.state: Optional[dict] = None
+        self.journal = None
+        self.journal_size = 0
+        self.lock = threading.Lock()
 
-    def is_non_zero_file(self):
-        return (os.path.isfile(self.file_path) and
-                os.path.getsize(self.file_path) > 0)
+    def is_non_zero_file(self, file_path: Optional[str] = None):
+        file_path = file_path or self.file_path
+        return os.path.isfile(file_path) and os.path.getsize(file_path) > 0
 
     def save_state(self, state: dict):
-        current_state = self.retrieve_state()
-        current_state.update(state)
+        with self.lock:
+            self.load()
+            self.state.update(state)
+            self.journal.write(json.dumps(state) + '\n')
+            self.journal.flush()
+            if self.fsync:
+                os.fsync(self.journal.fileno())
 
-        with open(self.file_path, 'w') as storage_file:
-            json.dump(current_state, storage_file)
+            self.journal_size += 1
+            if self.journal_size >= self.compact_every:
+                self.compact()
 
     def retrieve_state(self) -> dict:
-        if not self.is_non_zero_file():
-            return {}
+        with self.lock:
+            self.load()
+            return dict(self.state)
+
+    def retrieve_value(self, key: str) -> Any:
+        with self.lock:
+            self.load()
+            return self.state.get(key)
+
+    def load(self) -> None:
+        """Прочитать снимок и применить к нему записи журнала"""
+        if self.state is not None:
+            return
+
+        self.state = {}
+        if self.is_non_zero_file():
+            with open(self.file_path, 'r') as storage_file:
+                self.state = json.load(storage_file)
+        torn = False
+        if self.is_non_zero_file(self.journal_path):
+            with open(self.journal_path, 'r') as journal:
+                for line in journal:
+                    try:
+                        self.state.update(json.loads(line))
+                    except ValueError:
+                        torn = True
+                        break
+                    self.journal_size += 1
+        self.open_journal('a')
+        if torn:
+            self.compact()
+
+    def compact(self) -> None:
+        """Записать снимок состояния и начать журнал заново"""
+        directory = os.path.dirname(os.path.abspath(self.file_path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as snapshot:
+                json.dump(self.state, snapshot)
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.replace(temp_path, self.file_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+        self.journal.close()
+        self.open_journal('w')
 
-        with open(self.file_path, 'r') as storage_file:
-            return json.load(storage_file)
+    def open_journal(self, mode: str) -> None:
+        self.journal = open(self.journal_path, mode)
+        if mode == 'w':
+            self.journal_size = 0
 
 
 class RedisStorage(BaseStorage):
-    def __init__(self, host='127.0.0.1'):
+    """
+    Состояние хранится только в одном хеше с пространством имён, ключи
+    базы, общей с брокером и результатами Celery, не читаются и не
+    удаляются.
+    Если блокировка запуска потеряна, состояние больше не сохраняется:
+    контрольные точки двигает уже другой запуск.
+    """
+
+    def __init__(self, host='127.0.0.1', namespace: str = 'etl:state'):
         self.redis_cache = redis.Redis(host=host, decode_responses=True)
+        self.namespace = namespace
+        self.lease_lost = threading.Event()
 
     def save_state(self, state: dict):
-        self.redis_cache.mset(state)
+        if self.lease_lost.is_set():
+            raise LeaseLostError(
+                'The run lock was lost, the state was not saved'
+            )
+        self.write_state(state)
+
+    @backoff(policy='redis')
+    def write_state(self, state: dict):
+        self.redis_cache.hset(self.namespace, mapping=state)
 
+    @backoff(policy='redis')
     def retrieve_state(self) -> dict:
-        all_keys = self.redis_cache.keys()
-        if not all_keys:
-            return {}
-        return dict(zip(all_keys, self.redis_cache.mget(*all_keys)))
+        return self.redis_cache.hgetall(self.namespace)
+
+    def with_namespace(self, namespace: str) -> 'RedisStorage':
+        """Хранилище в другом пространстве имён с тем же подключением"""
+        storage = copy.copy(self)
+        storage.namespace = namespace
+        storage.lease_lost = threading.Event()
+        return storage
+
+    @backoff(policy='redis')
+    def retrieve_value(self, key: str) -> Any:
+        return self.redis_cache.hget(self.namespace, key)
+
+    @backoff(policy='redis')
+    def migrate_keys(self, keys: Iterable[str]) -> None:
+        """
+        Однократно перенести в хеш значения ключей, которые прежние версии
+        хранили отдельными ключами базы. Перенос выполняется, только пока
+        в хеше нет ни одного из них, старые ключи не удаляются.
+        """
+        keys = list(keys)
+        if any(self.redis_cache.hmget(self.namespace, keys)):
+            return
+        values = {key: value
+                  for key, value in zip(keys, self.redis_cache.mget(keys))
+                  if value is not None}
+        if values:
+            self.redis_cache.hset(self.namespace, mapping=values)
+            logger.info(f'Keys {list(values)} were moved into '
+                        f'"{self.namespace}"')
+
+    @contextmanager
+    def lease(self, name: str, timeout: int) -> Iterator[bool]:
+        """
+        Захватить распределённую блокировку на время работы.
+        Блокировка продлевается, пока работа не закончится, и освобождается
+        сама по истечении timeout, если процесс завершился аварийно.
+        Если продлить блокировку не удалось, потеря отмечается в lease_lost
+        и следующее сохранение состояния прерывает работу LeaseLostError.
+        """
+        lock = self.redis_cache.lock(f'{self.namespace}:lock:{name}',
+                                     timeout=timeout, thread_local=False)
+        if not lock.acquire(blocking=False):
+            yield False
+            return
+
+        self.lease_lost.clear()
+        stopped = threading.Event()
+
+        def renew():
+            while not stopped.wait(timeout / 3):
+                try:
+                    lock.reacquire()
+                except LockError as e:
+                    logger.error(f'Lock {name} was lost: {e}')
+                    self.lease_lost.set()
+                    return
+                except redis.RedisError as e:
+                    logger.warning(f'Lock {name} was not renewed: {e}')
+
+        renewal = threading.Thread(target=renew, daemon=True)
+        renewal.start()
+        try:
+            yield True
+        finally:
+            stopped.set()
+            renewal.join()
+            try:
+                lock.release()
+            except LockError:
+                pass
 
 
 class State:
@@ -64,11 +238,24 @@ class State:
 
     def __init__(self, storage: BaseStorage):
         self.storage = storage
+        self.cache = {}
+
+    def reset(self) -> None:
+        """Сбросить локальный кеш, чтобы перечитать состояние из хранилища"""
+        self.cache = {}
 
     def set_state(self, key: str, value: Any) -> None:
         """Установить состояние для определённого ключа"""
-        self.storage.save_state({key: value})
+        self.set_states({key: value})
+
+    def set_states(self, values: dict) -> None:
+        """Установить состояние сразу для нескольких ключей"""
+        if values:
+            self.storage.save_state(values)
+            self.cache.update(values)
 
     def get_state(self, key: str) -> Any:
         """Получить состояние по определённому ключу"""
-        return self.storage.retrieve_state().get(key)
+        if key not in self.cache:
+            self.cache[key] = self.storage.retrieve_value(key)
+        return self.cache[key]
@@ -1,40 +1,415 @@
+import asyncio
+import inspect
 import logging
+import random
+import threading
+import time
 from functools import wraps
-from time import sleep
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
 
 logger = logging.getLogger(__name__)
 
+RETRYABLE_ES_STATUSES = (429, 502, 503, 504)
 
-def backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10, logger=None):
+
+class RetryLimitError(Exception):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stop calling a dependency after several failures in a row.
+    Once reset_timeout passes a single trial call is let through: its success
+    closes the circuit, its failure keeps the circuit open for another period.
+    The breaker is shared by every function retried with the same policy,
+    so callers wait together instead of hammering a recovering service.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5,
+                 reset_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def check(self) -> None:
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.trial or self.remaining() > 0:
+                raise CircuitOpenError(f'Circuit of {self.name} is open')
+            self.trial = True
+
+    def remaining(self) -> float:
+        if self.opened_at is None:
+            return 0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def record_success(self) -> None:
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info(f'Circuit of {self.name} was closed')
+            self.failures, self.opened_at, self.trial = 0, None, False
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.opened_at is not None:
+                self.opened_at = time.monotonic()
+            elif self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                logger.warning(f'Circuit of {self.name} was opened after '
+                               f'{self.failures} failures')
+
+
+class RetryPolicy:
+    """
+    Retry settings of a dependency: which errors are worth retrying,
+    how long to sleep between attempts and the shared circuit breaker.
+    Sleeps use full jitter: a random time up to the exponential bound.
+    recover is called with the arguments of the failed call before it is
+    retried, to bring the dependency back into a usable state. It may
+    return an awaitable, which is awaited by coroutine functions.
+    """
+
+    def __init__(self, name: str,
+                 retryable: Tuple[Type[BaseException], ...] = (Exception,),
+                 fatal: Tuple[Type[BaseException], ...] = (),
+                 classify: Optional[Callable[[Exception], bool]] = None,
+                 start_sleep_time: float = 0.1, factor: float = 2,
+                 border_sleep_time: float = 10,
+                 breaker: Optional[CircuitBreaker] = None,
+                 recover: Optional[Callable[[Tuple], None]] = None):
+        self.name = name
+        self.retryable = retryable
+        self.fatal = fatal
+        self.classify = classify
+        self.start_sleep_time = start_sleep_time
+        self.factor = factor
+        self.border_sleep_time = border_sleep_time
+        self.breaker = breaker
+        self.recover = recover
+
+    def is_retryable(self, error: Exception) -> bool:
+        if isinstance(error, self.fatal):
+            return False
+        if self.classify is not None and self.classify(error):
+            return True
+        return isinstance(error, self.retryable)
+
+    def get_sleep_time(self, attempt: int) -> Optional[float]:
+        """Sleep before the next attempt, None when attempts are exhausted"""
+        bound = self.start_sleep_time * (self.factor ** attempt)
+        if bound >= self.border_sleep_time:
+            return None
+        return random.uniform(0, bound)
+
+
+def recover_connection(args: Tuple) -> Any:
+    """
+    Recover the connection the failed method works with, if it is able to:
+    roll back its aborted transaction or reopen it after it was lost.
+    """
+    connection = getattr(args[0], 'connection', None) if args else None
+    recover = getattr(connection, 'recover', None)
+    if callable(recover):
+        return recover()
+    return None
+
+
+def postgres_policy() -> RetryPolicy:
+    """
+    Lost connections are retried too: methods retried with this policy
+    work with a connection which is reopened by recover_connection, and
+    generators are resumed after their last yielded item.
+    """
+    import psycopg2
+
+    retryable = [psycopg2.OperationalError, psycopg2.InterfaceError,
+                 asyncio.TimeoutError, OSError]
+    try:
+        import asyncpg
+    except ImportError:
+        pass
+    else:
+        retryable += [
+            asyncpg.exceptions.SerializationError,
+            asyncpg.exceptions.DeadlockDetectedError,
+            asyncpg.exceptions.QueryCanceledError,
+            asyncpg.exceptions.PostgresConnectionError,
+            asyncpg.exceptions.InterfaceError,
+        ]
+    return RetryPolicy(
+        'postgres', retryable=tuple(retryable), border_sleep_time=30,
+        breaker=CircuitBreaker('postgres', reset_timeout=30),
+        recover=recover_connection
+    )
+
+
+def is_es_retryable(error: Exception) -> bool:
+    from elasticsearch import ApiError, ConnectionTimeout
+    from elasticsearch import ConnectionError as ESConnectionError
+
+    if isinstance(error, (ESConnectionError, ConnectionTimeout)):
+        return True
+    if isinstance(error, ApiError):
+        return error.meta.status in RETRYABLE_ES_STATUSES
+    return False
+
+
+def elasticsearch_policy() -> RetryPolicy:
+    from elasticsearch.helpers import BulkIndexError
+
+    return RetryPolicy(
+        'elasticsearch', retryable=(ConnectionError,),
+        fatal=(BulkIndexError,), classify=is_es_retryable,
+        breaker=CircuitBreaker('elasticsearch', reset_timeout=15)
+    )
+
+
+def redis_policy() -> RetryPolicy:
+    from redis.exceptions import ConnectionError as RedisConnectionError
+    from redis.exceptions import TimeoutError as RedisTimeoutError
+
+    return RetryPolicy(
+        'redis', retryable=(RedisConnectionError, RedisTimeoutError),
+        border_sleep_time=5,
+        breaker=CircuitBreaker('redis', reset_timeout=10)
+    )
+
+
+POLICY_FACTORIES: Dict[str, Callable[[], RetryPolicy]] = {
+    'default': lambda: RetryPolicy('default'),
+    'postgres': postgres_policy,
+    'elasticsearch': elasticsearch_policy,
+    'redis': redis_policy,
+}
+policies: Dict[str, RetryPolicy] = {}
+policies_lock = threading.Lock()
+
+
+def get_policy(name: str) -> RetryPolicy:
+    """Get the process wide policy, so its circuit breaker is shared"""
+    with policies_lock:
+        if name not in policies:
+            policies[name] = POLICY_FACTORIES[name]()
+        return policies[name]
+
+
+retry_listeners: List[Callable[[str, str], None]] = []
+
+
+def add_retry_listener(listener: Callable[[str, str], None]) -> None:
+    """Call the listener with the policy and function name on every retry"""
+    retry_listeners.append(listener)
+
+
+class Retry:
+    """State of the retries of a single call"""
+
+    def __init__(self, policy: RetryPolicy, func: Callable,
+                 log: Optional[logging.Logger] = None):
+        self.policy = policy
+        self.func = func
+        self.log = log or logger
+        self.attempt = 0
+
+    def before_call(self) -> None:
+        if self.policy.breaker is not None:
+            self.policy.breaker.check()
+
+    def succeeded(self) -> None:
+        self.attempt = 0
+        if self.policy.breaker is not None:
+            self.policy.breaker.record_success()
+
+    def failed(self, error: Exception) -> Optional[float]:
+        """
+        Get the sleep time before the next attempt.
+        None is returned for a fatal error, which should be raised as is.
+        """
+        breaker = self.policy.breaker
+        if not isinstance(error, CircuitOpenError):
+            if not self.policy.is_retryable(error):
+                if breaker is not None:
+                    breaker.record_success()
+                return None
+            if breaker is not None:
+                breaker.record_failure()
+
+        sleep_time = self.policy.get_sleep_time(self.attempt)
+        if sleep_time is None:
+            raise RetryLimitError(
+                f'Max sleep time {self.policy.border_sleep_time} seconds '
+                f'for {self.func.__qualname__} function was achieved'
+            ) from error
+        if breaker is not None:
+            sleep_time = max(sleep_time, breaker.remaining())
+
+        self.attempt += 1
+        for listener in retry_listeners:
+            listener(self.policy.name, self.func.__qualname__)
+        self.log.info(f'During execution the error occurred: \n {error}')
+        return sleep_time
+
+    def recover(self, args: Tuple = ()) -> Any:
+        """Recover the dependency after the sleep, before the next attempt"""
+        if self.policy.recover is not None:
+            return self.policy.recover(args)
+        return None
+
+
+def backoff(start_sleep_time: Optional[float] = None,
+            factor: Optional[float] = None,
+            border_sleep_time: Optional[float] = None,
+            logger: Optional[logging.Logger] = None,
+            policy: str = 'default',
+            resume: Optional[Callable[[Any], Dict]] = None):
     """
     A function to re-execute the function after some time if an error occurs.
-    Uses exponential growth of the repeat time up to the boundary sleep time
+    Uses exponential growth of the repeat time up to the boundary sleep time,
+    every sleep is a random time up to the bound (full jitter)
 
     Formula:
-    t = start_sleep_time * 2^(n) if t < border_sleep_time else border_sleep_time
+    t = random(0, start_sleep_time * factor^(n)) while the bound is less
+    than border_sleep_time
 
     :param start_sleep_time: start repeat time
     :param factor: the exponent
     :param border_sleep_time: limit waiting time
+    :param policy: name of the dependency policy, see POLICY_FACTORIES
+    :param resume: for generator functions, maps the last yielded item
+        to the arguments which continue the iteration after it
     :return: function execution result
+
+    Only errors classified by the policy as retryable are retried, others
+    are raised at once. Coroutine functions are retried with non-blocking
+    sleeps. Generator functions, also asynchronous ones, are retried from
+    the start while nothing was yielded, afterwards only when resume
+    is given.
     """
 
+    def get_retry(func: Callable) -> Retry:
+        base = get_policy(policy)
+        timings = {
+            'start_sleep_time': start_sleep_time,
+            'factor': factor,
+            'border_sleep_time': border_sleep_time,
+        }
+        if any(value is not None for value in timings.values()):
+            base = RetryPolicy(**{
+                **vars(base),
+                **{key: value for key, value in timings.items()
+                   if value is not None},
+            })
+        return Retry(base, func, logger)
+
     def func_wrapper(func):
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_inner(*args, **kwargs):
+                retry = get_retry(func)
+                while True:
+                    try:
+                        retry.before_call()
+                        result = await func(*args, **kwargs)
+                    except Exception as e:
+                        sleep_time = retry.failed(e)
+                        if sleep_time is None:
+                            raise
+                        await asyncio.sleep(sleep_time)
+                        recovered = retry.recover(args)
+                        if inspect.isawaitable(recovered):
+                            await recovered
+                    else:
+                        retry.succeeded()
+                        return result
+            return async_inner
+
+        if inspect.isasyncgenfunction(func):
+            signature = inspect.signature(func)
+
+            @wraps(func)
+            async def async_generator_inner(*args, **kwargs):
+                retry = get_retry(func)
+                arguments = signature.bind(*args, **kwargs)
+                yielded, last_item = False, None
+                while True:
+                    try:
+                        retry.before_call()
+                        async for item in func(*arguments.args,
+                                               **arguments.kwargs):
+                            retry.succeeded()
+                            yielded, last_item = True, item
+                            yield item
+                        return
+                    except Exception as e:
+                        if yielded and resume is None:
+                            raise
+                        sleep_time = retry.failed(e)
+                        if sleep_time is None:
+                            raise
+                        if yielded:
+                            arguments.arguments.update(resume(last_item))
+                        await asyncio.sleep(sleep_time)
+                        recovered = retry.recover(arguments.args)
+                        if inspect.isawaitable(recovered):
+                            await recovered
+            return async_generator_inner
+
+        if inspect.isgeneratorfunction(func):
+            signature = inspect.signature(func)
+
+            @wraps(func)
+            def generator_inner(*args, **kwargs):
+                retry = get_retry(func)
+                arguments = signature.bind(*args, **kwargs)
+                yielded, last_item = False, None
+                while True:
+                    try:
+                        retry.before_call()
+                        for item in func(*arguments.args,
+                                         **arguments.kwargs):
+                            retry.succeeded()
+                            yielded, last_item = True, item
+                            yield item
+                        return
+                    except Exception as e:
+                        if yielded and resume is None:
+                            raise
+                        sleep_time = retry.failed(e)
+                        if sleep_time is None:
+                            raise
+                        if yielded:
+                            arguments.arguments.update(resume(last_item))
+                        time.sleep(sleep_time)
+                        retry.recover(arguments.args)
+            return generator_inner
+
         @wraps(func)
         def inner(*args, **kwargs):
-            sleep_time, n = start_sleep_time, 1
-            while sleep_time < border_sleep_time:
+            retry = get_retry(func)
+            while True:
                 try:
-                    return func(*args, **kwargs)
+                    retry.before_call()
+                    result = func(*args, **kwargs)
                 except Exception as e:
-                    logger.info(f'During execution the error occurred: \n {e}')
-                    sleep(sleep_time)
-                    sleep_time = start_sleep_time * (factor ** n)
-                n += 1
-            raise Exception(
-                f'Max sleep time {border_sleep_time} seconds '
-                f'for {func.__qualname__} function was achieved'
-            )
+                    sleep_time = retry.failed(e)
+                    if sleep_time is None:
+                        raise
+                    time.sleep(sleep_time)
+                    retry.recover(args)
+                else:
+                    retry.succeeded()
+                    return result
         return inner
 
     return func_wrapper